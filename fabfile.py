@@ -1,8 +1,41 @@
-from fabric.api import put, task, cd, env, local
-from fabric.contrib.project import rsync_project
+import io
+import json
+import posixpath
+
+from fabric.api import abort, put, task, env, local, run, settings, hide
 
 env.hosts = ['pyformat@pyformat.info']
 
+SITE_PATH = '/var/www/pyformat.info'
+
+# Fabric 1.x only runs on Python 2, so main can't be imported here. These
+# mirror BUILD_MANIFEST_PATH, DEPLOY_MANIFEST_NAME and plan_deploy in main.
+BUILD_MANIFEST_PATH = '.cache/build-manifest.json'
+DEPLOY_MANIFEST_NAME = '.deploy-manifest.json'
+
+
+def is_page(name):
+    return name.endswith(('.html', '.html.gz', '.html.br'))
+
+
+def plan_deploy(manifest, deployed):
+    changed = [name for name, digest in manifest.items() if deployed.get(name) != digest]
+    return sorted(changed, key=is_page)
+
+
+def read_build_manifest():
+    try:
+        with io.open(BUILD_MANIFEST_PATH, encoding='utf-8') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def read_deployed_manifest():
+    with settings(hide('everything'), warn_only=True):
+        result = run('cat {}'.format(posixpath.join(SITE_PATH, DEPLOY_MANIFEST_NAME)))
+    return json.loads(result) if result.succeeded else {}
+
 
 @task
 def generate():
@@ -11,6 +44,13 @@ def generate():
 
 @task(default=True)
 def deploy():
-    with cd('/var/www/pyformat.info'):
-        put('index.html', './')
-    rsync_project('/var/www/pyformat.info/', 'assets')
+    manifest = read_build_manifest()
+    if not manifest:
+        abort("No build found, run `fab generate` first.")
+    for name in plan_deploy(manifest, read_deployed_manifest()):
+        target = posixpath.join(SITE_PATH, name)
+        run('mkdir -p {}'.format(posixpath.dirname(target)))
+        put(name, target + '.tmp')
+        run('mv {0}.tmp {0}'.format(target))
+    data = json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+    put(io.BytesIO(data), posixpath.join(SITE_PATH, DEPLOY_MANIFEST_NAME))
@@ -1,25 +1,31 @@
 import ast
 import _ast
 import datetime
+import gzip
 import hashlib
+import json
 import logging
+import os
+import posixpath
+import re
+import shutil
 import subprocess
 import sys
+import threading
+import time
 from logging import getLogger
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from glob import glob
 from pathlib import Path
-from textwrap import indent
+from shutil import copytree
+from tempfile import TemporaryDirectory
+from textwrap import dedent, indent
 from subprocess import run, PIPE
 
-import jinja2
-import sass
 import click
-import markdown
-import pygments
-import pygments.formatters
-import pygments.lexers
-import pytz
-import astunparse
 from rex import rex
 
 
@@ -27,103 +33,2047 @@ log = getLogger(__name__)
 
 CONTENT_MODULE_PATH = Path("tests/test_content.py")
 
+# Content modules picked up from a content directory.
+CONTENT_MODULE_PATTERN = "test_*.py"
+
+# path sorts all content modules by their path, given keeps the order of the
+# given sources and only sorts the modules matched by each of them.
+CONTENT_ORDERS = ('path', 'given')
+
+CACHE_PATH = Path(".cache")
+
+BUILD_STATE_PATH = CACHE_PATH / "build.json"
+
+FRAGMENT_CACHE_PATH = CACHE_PATH / "fragments"
+
+FRAGMENT_TEMPLATE = "_macros.html"
+
+TEMPLATES = ("_layout.html", "_macros.html", "index.html", "page.html")
+
+JINJA_CACHE_PATH = CACHE_PATH / "jinja"
+
+PROFILE_PATH = CACHE_PATH / "profile"
+
+PARSE_CACHE_PATH = CACHE_PATH / "content"
+
+TOOL_VERSIONS_PATH = CACHE_PATH / "versions.json"
+
+# Content hashes of the files written by the last `generate`.
+BUILD_MANIFEST_PATH = CACHE_PATH / "build-manifest.json"
+
+# Content hashes of the files of the last deploy, kept in the target.
+DEPLOY_MANIFEST_NAME = ".deploy-manifest.json"
+
+# Build manifests of previous builds, see record_build.
+MANIFEST_HISTORY_PATH = CACHE_PATH / "manifests"
+
+# Number of previous builds whose assets are kept by the asset GC.
+MANIFEST_HISTORY_SIZE = 3
+
+# Folders holding content hashed assets, only those are garbage collected.
+HASHED_ASSET_PATHS = (Path("assets/css"), Path("assets/search"))
+
+HASHED_ASSET_RE = re.compile(r'\.[0-9a-f]{8}\.')
+
+# Bump whenever parse_function or parse_class produce different records.
+PARSER_VERSION = 1
+
+PYGMENTS_STYLE = "default"
+
+# Bump whenever the output of the template filters changes.
+FILTERS_VERSION = 1
+
+FILTER_CACHE_SIZE = 1024
+
+RUST_CACHE_PATH = CACHE_PATH / "rust"
+
+RUST_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+
+RUST_CACHE_MAX_SIZE = 10 * 1024 * 1024
+
 OUTPUT_RE = rex(r"""s/^.*?assert .*? == ['"](.*)['"].*?# output$\n/\1/""")
 
-Section = namedtuple('Section', ('name', 'title', 'details', 'examples'))
+Section = namedtuple('Section', ('name', 'title', 'details', 'examples'))
+
+Example = namedtuple("Example", ('name', 'title', 'details', 'setup', 'python_old', 'python_new', 'rust', 'output'))
+
+Version = namedtuple('Version', ('revid', 'datetime', 'language_versions'))
+
+RustResult = namedtuple('RustResult', ('stdout', 'returncode'))
+
+# Where generate_html reads templates and styles from and writes assets to.
+# With a cache folder the template bytecode and the fragments are kept in
+# it instead of JINJA_CACHE_PATH and FRAGMENT_CACHE_PATH.
+SitePaths = namedtuple('SitePaths', ('templates', 'sass', 'css', 'search', 'vendor', 'cache'))
+
+BENCHMARK_BASELINE_PATH = Path("benchmarks/baseline.json")
+
+BENCHMARK_STAGES = ('get_content', 'parse_function', 'generate_css', 'highlight', 'generate_html')
+
+BENCHMARK_TOLERANCE = 0.25
+
+SYNTHETIC_EXAMPLE_TEMPLATE = '''def test_synthetic_{idx}():
+    """
+    # Synthetic example {idx}
+
+    Pads the number {idx} to `{width}` characters.
+    """
+    value = {idx}
+
+    old_result = '%{width}d' % (value, )
+    new_result = '{{:{width}}}'.format(value)
+    rust_result = 'format!("{{:{width}}}", {idx})'
+
+    assert old_result == new_result
+    assert new_result == '{expected}'  # output
+'''
+
+SYNTHETIC_SECTION_TEMPLATE = '''class TestSynthetic{idx}(object):
+    """
+    # Synthetic section {idx}
+    """
+
+'''
+
+HASH_PLACEHOLDER = "__HASH__"
+
+LIVE_RELOAD_SCRIPT = """<script>
+    (function() {
+        var generation = null;
+        setInterval(function() {
+            var request = new XMLHttpRequest();
+            request.onload = function() {
+                if (generation !== null && generation !== request.responseText) {
+                    location.reload();
+                }
+                generation = request.responseText;
+            };
+            request.open('GET', '/__generation');
+            request.send();
+        }, 300);
+    })();
+</script>
+"""
+
+SOURCE_MAP_REFERENCE = "\n/*# sourceMappingURL="
+
+SEARCH_INDEX_PATH = Path("assets/search")
+
+# Third-party stylesheets served from our own origin. `pyformat vendor`
+# downloads them into VENDOR_PATH, from where generate_css hashes them into
+# the stylesheet folder like the compiled SCSS. Until then the templates
+# link them from their CDN.
+VENDOR_PATH = Path("assets/vendor")
+
+# name -> (url, sha256). An asset without a sha256 isn't pinned yet and is
+# never written; `pyformat vendor` reports the digest of what it got so it
+# can be checked against the CDN's SRI hash and pinned here.
+VENDOR_ASSETS = OrderedDict([
+    ('gh-fork-ribbon.min.css',
+     ('https://cdnjs.cloudflare.com/ajax/libs/github-fork-ribbon-css/0.1.1/gh-fork-ribbon.min.css',
+      None)),
+])
+
+# Elements whose content is kept as is when minifying HTML.
+PRESERVED_ELEMENTS_RE = re.compile(r'(<(pre|script|style|textarea)\b.*?</\2\s*>)',
+                                   re.DOTALL | re.IGNORECASE)
+
+# Comments except conditional ones.
+HTML_COMMENT_RE = re.compile(r'<!--(?!\[if|<!|>).*?-->', re.DOTALL)
+
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)(.*?)\1\s*\)''')
+
+STYLESHEET_LINK_RE = re.compile(r'<link href="(assets/[^"]+\.css)" rel="stylesheet">')
+
+# How much of a page counts as above the fold when extracting critical CSS,
+# roughly what arrives with the first round trip.
+CRITICAL_HTML_SIZE = 14 * 1024
+
+DEFAULT_SITE_PATHS = SitePaths(templates=Path("templates"), sass=Path("assets/sass"),
+                               css=Path("assets/css"), search=SEARCH_INDEX_PATH,
+                               vendor=VENDOR_PATH, cache=None)
+
+SEARCH_INDEX_VERSION = 1
+
+# Python and Rust string literals, format specifiers are only looked for in
+# there so that e.g. the % operator isn't taken for one.
+STRING_LITERAL_RE = re.compile(r'''(['"])((?:\\.|(?!\1).)*)\1''')
+
+# Replacement fields like {:>10} or {0!r} and printf-style specifiers like
+# %-5d or %(name)s.
+FORMAT_SPEC_RE = re.compile(
+    r'\{[^{}\s]*\}|%(?:\([^)]*\))?[-+ #0]*(?:\*|\d+)?(?:\.(?:\*|\d+))?[a-zA-Z%]')
+
+WORD_RE = re.compile(r'[a-z0-9]+')
+
+RUST_SNIPPET_TEMPLATE = '''fn main () {{
+    let s = {};
+    println!("{{}}", s);
+}}
+'''
+
+RUST_BATCH_FUNCTION_TEMPLATE = '''fn example_{}() -> String {{
+    let s = {};
+    format!("{{}}", s)
+}}
+'''
+
+RUST_BATCH_MAIN_TEMPLATE = '''fn main () {{
+    for s in &[{}] {{
+        print!("{{}}\\n{{}}", s.len(), s);
+    }}
+}}
+'''
+
+
+class Profiler(object):
+    """
+    Profiler records timed spans of a build, which can be exported as Chrome
+    trace events or summarized. It does nothing until enabled, so spans can
+    stay in place at next to no cost. Build stages can additionally be
+    profiled with cProfile.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile_path = None
+        self.spans = []
+        self.origin = time.perf_counter()
+        self._profiling = False
+
+    def enable(self, cprofile_path=None):
+        self.enabled = True
+        self.cprofile_path = Path(cprofile_path) if cprofile_path is not None else None
+        self.spans = []
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start - self.origin, time.perf_counter() - start,
+                               threading.get_ident(), args))
+
+    @contextmanager
+    def stage(self, name):
+        """
+        stage records a span for the given build stage and, if requested,
+        writes a cProfile dump of it to cprofile_path.
+        """
+        with self.span('stage:' + name):
+            if self.cprofile_path is None or self._profiling:
+                yield
+                return
+            import cProfile
+            profile = cProfile.Profile()
+            self._profiling = True
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                self._profiling = False
+                self.cprofile_path.mkdir(parents=True, exist_ok=True)
+                profile.dump_stats(str(self.cprofile_path / (
+                    re.sub(r'[^\w.-]+', '_', name) + '.prof')))
+
+    def trace(self):
+        """
+        trace returns the recorded spans in the Chrome trace event format.
+        """
+        pid = os.getpid()
+        return {
+            'displayTimeUnit': 'ms',
+            'traceEvents': [{
+                'name': name,
+                'cat': 'build',
+                'ph': 'X',
+                'ts': round(start * 1e6, 3),
+                'dur': round(duration * 1e6, 3),
+                'pid': pid,
+                'tid': tid,
+                'args': args,
+            } for name, start, duration, tid, args in self.spans],
+        }
+
+    def write_trace(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(path), 'w', encoding='utf-8') as fp:
+            json.dump(self.trace(), fp, separators=(',', ':'))
+
+    def summary(self, top=10):
+        """
+        summary returns (name, count, total, max) for the `top` span names
+        with the largest total duration.
+        """
+        totals = OrderedDict()
+        for name, _, duration, _, _ in self.spans:
+            count, total, longest = totals.get(name, (0, 0.0, 0.0))
+            totals[name] = (count + 1, total + duration, max(longest, duration))
+        rows = [(name,) + values for name, values in totals.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)[:top]
+
+
+profiler = Profiler()
+
+
+def unparse(node, strip=None):
+    """
+    unparse regenerates source code for the given node or list of nodes. This
+    is only used where the original source is not available, see
+    SourceSlicer.
+    """
+    if hasattr(ast, 'unparse'):
+        nodes = node if isinstance(node, list) else [node]
+        result = '\n'.join(ast.unparse(n) for n in nodes)
+        return result.strip() if strip else result
+    import astunparse
+    result = astunparse.unparse(node)
+    if strip:
+        result = result.lstrip().rstrip()
+        if isinstance(node, _ast.BinOp):
+            return result[1:-1]
+    return result
+
+
+class SourceSlicer(object):
+    """
+    SourceSlicer returns the original source of AST nodes by slicing the
+    buffer the module was parsed from at the nodes' line and column offsets,
+    so the author's formatting is kept exactly. Column offsets are UTF-8 byte
+    offsets, which is why the buffer is sliced as bytes.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        self.buffer = memoryview(source)
+        self.line_offsets = [0]
+        for line in source.splitlines(True):
+            self.line_offsets.append(self.line_offsets[-1] + len(line))
+
+    @staticmethod
+    def supported():
+        # End positions of nodes are available as of Python 3.8.
+        return sys.version_info >= (3, 8)
+
+    def _slice(self, start, node):
+        end = self.line_offsets[node.end_lineno - 1] + node.end_col_offset
+        return self.buffer[start:end].tobytes().decode('utf-8')
+
+    def node(self, node):
+        """
+        node returns the source of a single expression node.
+        """
+        return self._slice(self.line_offsets[node.lineno - 1] + node.col_offset, node)
+
+    def statements(self, nodes):
+        """
+        statements returns the dedented source of the given consecutive
+        statements, including decorators and any comments between them.
+        """
+        first = min([nodes[0].lineno] + [
+            decorator.lineno for decorator in getattr(nodes[0], 'decorator_list', [])])
+        return dedent(self._slice(self.line_offsets[first - 1], nodes[-1])).strip()
+
+
+def literal_string(node):
+    """
+    literal_string returns the value of the given node if it is a string
+    literal and None otherwise.
+    """
+    # Constant only exists from Python 3.6 and Str is gone in 3.12.
+    if isinstance(node, getattr(_ast, 'Constant', ())) and isinstance(node.value, str):
+        return node.value
+    if hasattr(_ast, 'Str') and isinstance(node, _ast.Str):
+        return node.s
+    return None
+
+
+def mtime(path):
+    """
+    mtime returns the modification time of path in nanoseconds or None if it
+    doesn't exist.
+    """
+    try:
+        return os.stat(str(path)).st_mtime_ns
+    except OSError:
+        return None
+
+
+def is_rustup_proxy(executable):
+    """
+    is_rustup_proxy tells whether the executable is one of the proxies
+    rustup installs for cargo, rustc and friends. rustup installs them as
+    hardlinks of itself into $CARGO_HOME/bin, so they are recognised by
+    their folder or by being the same file as rustup.
+    """
+    cargo_bin = Path(os.environ.get('CARGO_HOME', Path.home() / '.cargo')) / 'bin'
+    resolved = Path(os.path.realpath(executable))
+    if resolved.stem == 'rustup' or resolved.parent == Path(os.path.realpath(str(cargo_bin))):
+        return True
+    for rustup in (shutil.which('rustup'), str(cargo_bin / 'rustup')):
+        try:
+            if rustup and os.path.samefile(str(resolved), rustup):
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def rust_toolchain_file(path='.'):
+    """
+    rust_toolchain_file returns the rust-toolchain override file rustup uses
+    for the given folder: the first one found walking up from it, or None.
+    """
+    folder = Path(path).resolve()
+    for parent in [folder] + list(folder.parents):
+        for name in ('rust-toolchain', 'rust-toolchain.toml'):
+            if (parent / name).is_file():
+                return parent / name
+    return None
+
+
+def tool_version_key(executable):
+    """
+    tool_version_key returns what decides the version of the given
+    executable: its path and the modification time and size of the file it
+    resolves to. rustup proxies pick the toolchain at runtime, so for them
+    the rustup settings, the installed toolchains and the override file
+    for the working directory are part of the key as well.
+    """
+    resolved = os.path.realpath(executable)
+    stat = os.stat(resolved)
+    key = [executable, resolved, stat.st_mtime_ns, stat.st_size]
+    if is_rustup_proxy(executable):
+        rustup_home = Path(os.environ.get('RUSTUP_HOME', Path.home() / '.rustup'))
+        toolchain_file = rust_toolchain_file()
+        key += [os.environ.get('RUSTUP_TOOLCHAIN'), mtime(rustup_home / 'settings.toml'),
+                mtime(rustup_home / 'toolchains'), toolchain_file,
+                toolchain_file and mtime(toolchain_file)]
+    return ':'.join(str(part) for part in key)
+
+
+def tool_version(name, cache_path=None):
+    """
+    tool_version returns what `name --version` prints. The result is cached
+    in cache_path (TOOL_VERSIONS_PATH by default) under tool_version_key, so
+    the tool only has to be run again after it was replaced.
+    """
+    cache_path = Path(cache_path) if cache_path is not None else TOOL_VERSIONS_PATH
+    executable = shutil.which(name)
+    if executable is None:
+        return run([name, "--version"], stdout=PIPE).stdout.decode().strip()
+    key = tool_version_key(executable)
+    try:
+        with open(str(cache_path), encoding='utf-8') as fp:
+            versions = json.load(fp)
+    except (OSError, ValueError):
+        versions = {}
+    if key not in versions:
+        versions[key] = run([executable, "--version"], stdout=PIPE).stdout.decode().strip()
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix('.tmp')
+        with open(str(tmp), 'w', encoding='utf-8') as fp:
+            json.dump(versions, fp)
+        os.replace(str(tmp), str(cache_path))
+    return versions[key]
+
+
+@lru_cache()
+def rustc_version():
+    """
+    rustc_version returns the version string of the Rust compiler on PATH.
+    """
+    return tool_version("rustc")
+
+
+def python_version():
+    """
+    python_version returns the version of the running interpreter in the
+    format of `python --version`.
+    """
+    return "Python " + sys.version.split()[0]
+
+
+class RustCache(object):
+    """
+    RustCache stores the results of Rust snippets on disk. Entries are keyed
+    by a hash of the snippet and the compiler version so a toolchain update
+    invalidates them. Entries older than max_age seconds are dropped and the
+    least recently used ones are dropped once the cache exceeds max_size bytes.
+    """
+
+    def __init__(self, path=None, max_age=RUST_CACHE_MAX_AGE,
+                 max_size=RUST_CACHE_MAX_SIZE):
+        self.path = Path(path) if path is not None else RUST_CACHE_PATH
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def _entry_path(self, code):
+        digest = hashlib.sha256()
+        digest.update(rustc_version().encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(code.encode('utf-8'))
+        return self.path / (digest.hexdigest() + '.json')
+
+    def entries(self):
+        if not self.path.exists():
+            return []
+        return list(self.path.glob('*.json'))
+
+    def get(self, code):
+        entry = self._entry_path(code)
+        try:
+            with open(str(entry), encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        # Touch the entry so that eviction can drop the least recently used.
+        os.utime(str(entry), None)
+        return RustResult(data['stdout'], data['returncode'])
+
+    def set(self, code, result):
+        entry = self._entry_path(code)
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_suffix('.tmp')
+        with open(str(tmp), 'w', encoding='utf-8') as fp:
+            json.dump({'stdout': result.stdout, 'returncode': result.returncode}, fp)
+        os.replace(str(tmp), str(entry))
+
+    def evict(self, now=None):
+        """
+        evict removes expired entries and, if the cache is still too large,
+        the least recently used ones. Returns the number of removed entries.
+        """
+        now = time.time() if now is None else now
+        entries = sorted(((e.stat(), e) for e in self.entries()),
+                         key=lambda item: item[0].st_mtime)
+        size = sum(stat.st_size for stat, _ in entries)
+        removed = 0
+        for stat, entry in entries:
+            if now - stat.st_mtime <= self.max_age and size <= self.max_size:
+                break
+            entry.unlink()
+            size -= stat.st_size
+            removed += 1
+        return removed
+
+    def stats(self):
+        stats = [e.stat() for e in self.entries()]
+        mtimes = [stat.st_mtime for stat in stats]
+        return {
+            'path': str(self.path),
+            'entries': len(stats),
+            'size': sum(stat.st_size for stat in stats),
+            'oldest': min(mtimes) if mtimes else None,
+            'newest': max(mtimes) if mtimes else None,
+        }
+
+    def clear(self):
+        entries = self.entries()
+        for entry in entries:
+            entry.unlink()
+        return len(entries)
+
+
+def compile_rust(source, scratch_dir):
+    """
+    compile_rust writes the given Rust source into scratch_dir and compiles
+    it. Returns rustc's exit status and the path of the executable.
+    """
+    source_path = Path(scratch_dir) / 'snippets.rs'
+    with open(str(source_path), 'w', encoding='utf-8') as fp:
+        fp.write(source)
+    result = run(["rustc", "--out-dir={}".format(scratch_dir), str(source_path)])
+    return result.returncode, source_path.with_suffix('')
+
+
+def evaluate_rust(code):
+    """
+    evaluate_rust compiles and runs a single Rust expression and returns
+    what it prints together with the exit status.
+    """
+    with TemporaryDirectory(prefix='pyformat-rust-') as scratch_dir:
+        returncode, executable = compile_rust(RUST_SNIPPET_TEMPLATE.format(code), scratch_dir)
+        if returncode != 0:
+            return RustResult('', returncode)
+        result = run([str(executable)], stdout=PIPE)
+    return RustResult(result.stdout.decode().rstrip('\n'), result.returncode)
+
+
+def parse_rust_batch_output(names, output):
+    """
+    parse_rust_batch_output splits the length-prefixed output of a batch
+    program into a name -> output mapping.
+    """
+    results = OrderedDict()
+    position = 0
+    for name in names:
+        newline = output.index(b'\n', position)
+        length = int(output[position:newline])
+        position = newline + 1 + length
+        results[name] = output[newline + 1:position].decode().rstrip('\n')
+    return results
+
+
+def evaluate_rust_program(snippets):
+    """
+    evaluate_rust_program compiles the given snippets (a name -> code
+    mapping) into a single program with one function per snippet inside its
+    own scratch directory, runs it once and returns a name -> RustResult
+    mapping in the same order.
+
+    If the combined program does not compile or fails at runtime, every
+    snippet is evaluated on its own so that a single broken snippet doesn't
+    hide the others.
+    """
+    names = list(snippets)
+    source = '#![allow(warnings)]\n'
+    source += ''.join(RUST_BATCH_FUNCTION_TEMPLATE.format(idx, snippets[name])
+                      for idx, name in enumerate(names))
+    source += RUST_BATCH_MAIN_TEMPLATE.format(', '.join(
+        'example_{}()'.format(idx) for idx in range(len(names))))
+    with profiler.span('rust', snippets=len(names)), \
+            TemporaryDirectory(prefix='pyformat-rust-') as scratch_dir:
+        returncode, executable = compile_rust(source, scratch_dir)
+        if returncode == 0:
+            result = run([str(executable)], stdout=PIPE)
+            if result.returncode == 0:
+                return OrderedDict(
+                    (name, RustResult(output, 0)) for name, output
+                    in parse_rust_batch_output(names, result.stdout).items())
+    log.warning("Batch evaluation failed, evaluating snippets one by one.")
+    return OrderedDict((name, evaluate_rust(snippets[name])) for name in names)
+
+
+def evaluate_rust_batch(snippets, jobs=1):
+    """
+    evaluate_rust_batch splits the given snippets into up to `jobs` chunks,
+    evaluates each chunk as one program on a worker thread and returns a
+    name -> RustResult mapping in the order of the given snippets.
+    """
+    names = list(snippets)
+    if not names:
+        return OrderedDict()
+    jobs = max(1, min(jobs, len(names)))
+    log.info("Evaluating %d Rust snippets using %d jobs.", len(names), jobs)
+    size = -(-len(names) // jobs)
+    chunks = [OrderedDict((name, snippets[name]) for name in names[idx:idx + size])
+              for idx in range(0, len(names), size)]
+    results = OrderedDict()
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        for chunk_results in pool.map(evaluate_rust_program, chunks):
+            results.update(chunk_results)
+    return results
+
+
+def run_rust_batch(snippets, cache=None, jobs=1):
+    """
+    run_rust_batch returns a name -> output mapping for the given snippets.
+    Snippets found in the given RustCache are not compiled again; all others
+    are evaluated using up to `jobs` parallel compilations and stored in the
+    cache.
+    """
+    results = OrderedDict((name, None) for name in snippets)
+    missing = OrderedDict()
+    for name, code in snippets.items():
+        cached = cache.get(code) if cache is not None else None
+        if cached is None:
+            missing[name] = code
+        else:
+            results[name] = cached.stdout
+    if missing:
+        for name, result in evaluate_rust_batch(missing, jobs=jobs).items():
+            if cache is not None:
+                cache.set(missing[name], result)
+            results[name] = result.stdout
+        if cache is not None:
+            cache.evict()
+    return results
+
+
+def run_rust(code, cache=None):
+    """
+    run_rust returns what the given Rust expression prints, consulting the
+    given RustCache first.
+    """
+    return run_rust_batch({'snippet': code}, cache=cache)['snippet']
+
+
+def collect_rust_snippets(content):
+    """
+    collect_rust_snippets flattens the given sections and examples into a
+    name -> rust_result mapping.
+    """
+    snippets = OrderedDict()
+    for item in content:
+        examples = item.examples if isinstance(item, Section) else [item]
+        for example in examples:
+            if example.rust:
+                snippets[example.name] = example.rust
+    return snippets
+
+
+def check_rust_outputs(content, jobs=1):
+    """
+    check_rust_outputs evaluates every Rust snippet using up to `jobs`
+    parallel compilations and warns about examples whose Rust output differs
+    from the documented output.
+    """
+    examples = {}
+    for item in content:
+        for example in (item.examples if isinstance(item, Section) else [item]):
+            examples[example.name] = example
+    outputs = run_rust_batch(collect_rust_snippets(content), cache=RustCache(),
+                             jobs=jobs)
+    for name, output in outputs.items():
+        expected = examples[name].output
+        if expected and output != expected:
+            log.warning("Rust output of %s differs: %r != %r", name, output, expected)
+    return outputs
+
+
+def fingerprint(inputs):
+    """
+    fingerprint returns a hash over the given inputs. Paths contribute their
+    name and content (directories all files below them), everything else its
+    string representation.
+    """
+    digest = hashlib.sha256()
+    for item in inputs:
+        if isinstance(item, Path):
+            files = sorted(item.rglob('*')) if item.is_dir() else [item]
+            for file_ in files:
+                if file_.is_file():
+                    digest.update(str(file_).encode('utf-8') + b'\0')
+                    digest.update(file_.read_bytes())
+        else:
+            digest.update(str(item).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class BuildState(object):
+    """
+    BuildState remembers the input fingerprint, result and outputs of every
+    build stage. In incremental mode a stage whose fingerprint matches the
+    previous build and whose outputs still exist is skipped and its previous
+    result is reused. Only the stages run or skipped by the current build are
+    saved, so stages for files that are gone don't pile up. Without a path
+    nothing is persisted.
+    """
+
+    def __init__(self, path=None, incremental=False):
+        self.path = Path(path) if path is not None else None
+        self.incremental = incremental
+        self.stages = {}
+        self.executed = OrderedDict()
+        self.skipped = []
+        self.used = set()
+        if self.path is not None and self.path.exists():
+            with open(str(self.path), encoding='utf-8') as fp:
+                self.stages = json.load(fp)
+
+    def run(self, name, inputs, func, outputs=None, pure=False):
+        """
+        run executes func as the stage `name` unless it can be skipped.
+        `outputs` is an optional callable returning the paths the stage
+        produces for a given result. Pure stages depend on nothing but their
+        inputs and are skipped whenever possible, even in full builds.
+        """
+        digest = fingerprint(inputs)
+        previous = self.stages.get(name)
+        self.used.add(name)
+        if (self.incremental or pure) and previous and previous['fingerprint'] == digest \
+                and all(Path(p).exists() for p in previous['outputs']):
+            log.info("Skipping %s (inputs unchanged).", name)
+            self.skipped.append(name)
+            return previous['result']
+        start = time.perf_counter()
+        with profiler.stage(name):
+            result = func()
+        self.executed[name] = time.perf_counter() - start
+        self.stages[name] = {
+            'fingerprint': digest,
+            'result': result,
+            'outputs': [str(p) for p in outputs(result)] if outputs else [],
+        }
+        return result
+
+    @contextmanager
+    def timed(self, name):
+        """
+        timed records how long the wrapped block takes as a step of the
+        build.
+        """
+        start = time.perf_counter()
+        try:
+            with profiler.span(name):
+                yield
+        finally:
+            self.executed[name] = time.perf_counter() - start
+
+    def outputs(self):
+        """
+        outputs returns the paths of the outputs of the stages run or skipped
+        by the current build. Before any stage ran that's the stages of the
+        last saved build.
+        """
+        return set(Path(path).as_posix() for name, stage in self.stages.items()
+                   if not self.used or name in self.used for path in stage['outputs'])
+
+    def save(self):
+        if self.path is None:
+            return
+        self.stages = {name: stage for name, stage in self.stages.items()
+                       if name in self.used}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(self.path), 'w', encoding='utf-8') as fp:
+            json.dump(self.stages, fp, indent=2, sort_keys=True)
+
+    def report(self):
+        for name, duration in self.executed.items():
+            log.info("Stage %s took %.3fs.", name, duration)
+        if self.skipped:
+            log.info("Skipped stages: %s.", ', '.join(self.skipped))
+
+
+def generate_laugage_versions():
+    python = "Python version: " + python_version()
+    rust = "Rust version: " + rustc_version()
+    return [python, rust]
+
+
+def git_dir(path='.'):
+    """
+    git_dir returns the git directory of the repository containing path, or
+    None. Worktrees and submodules, whose .git is a file pointing to the
+    actual directory, are supported.
+    """
+    path = Path(path).resolve()
+    for folder in [path] + list(path.parents):
+        dot_git = folder / '.git'
+        if dot_git.is_dir():
+            return dot_git
+        if dot_git.is_file():
+            line = dot_git.read_text(encoding='utf-8').strip()
+            if line.startswith('gitdir:'):
+                return (folder / line[len('gitdir:'):].strip()).resolve()
+    return None
+
+
+def resolve_ref(git_path, ref):
+    """
+    resolve_ref returns the commit the given ref points to by reading the
+    loose ref or packed-refs, or None. Worktrees look the ref up in their
+    common directory as well.
+    """
+    folders = [git_path]
+    commondir = git_path / 'commondir'
+    if commondir.is_file():
+        folders.append((git_path / commondir.read_text(encoding='utf-8').strip()).resolve())
+    for folder in folders:
+        loose = folder / ref
+        if loose.is_file():
+            return loose.read_text(encoding='utf-8').strip()
+    for folder in folders:
+        packed = folder / 'packed-refs'
+        if packed.is_file():
+            for line in packed.read_text(encoding='utf-8').splitlines():
+                if line and line[0] not in '#^' and line.split(' ', 1)[1] == ref:
+                    return line.split(' ', 1)[0]
+    return None
+
+
+def git_revision(path='.'):
+    """
+    git_revision returns the commit HEAD points to in the repository
+    containing path, read straight from the git directory. Falls back to
+    `git rev-parse HEAD` if it can't be resolved that way.
+    """
+    git_path = git_dir(path)
+    if git_path is not None:
+        head = (git_path / 'HEAD').read_text(encoding='utf-8').strip()
+        if not head.startswith('ref:'):
+            return head
+        revid = resolve_ref(git_path, head[len('ref:'):].strip())
+        if revid:
+            return revid
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], cwd=str(path)).decode('utf-8').rstrip()
+
+
+def generate_revid():
+    return git_revision(Path(__file__).parent)
+
+def generate_version():
+    with profiler.span('version'):
+        revid = generate_revid()
+        import pytz
+        dt = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
+        return Version(revid=revid, datetime=dt, language_versions=generate_laugage_versions())
+
+
+def write_if_changed(path, content):
+    """
+    write_if_changed writes content to path unless the file already holds
+    exactly that content. Returns whether the file was written.
+    """
+    try:
+        with open(str(path), encoding='utf-8') as fp:
+            if fp.read() == content:
+                return False
+    except OSError:
+        pass
+    with profiler.span('write', path=str(path)):
+        with open(str(path), 'w', encoding='utf-8') as fp:
+            fp.write(content)
+    return True
+
+
+def write_chunks(path, chunks):
+    """
+    write_chunks writes the given chunks of text into path as they come.
+    """
+    with profiler.span('write', path=str(path)):
+        with open(str(path), 'w', encoding='utf-8') as fp:
+            fp.writelines(chunks)
+
+
+def render_sass(source_path, target_path_pattern, source_map=True):
+    """
+    render_sass compiles the given SCSS file once and returns the target path
+    (target_path_pattern formatted with a hash of the compiled CSS), the CSS
+    and the source map, if requested. The source map reference is not part of
+    the hash, so the name is the same with and without source maps.
+    """
+    import sass
+    log.info("Compiling SCSS.")
+    placeholder_path = str(target_path_pattern).format(HASH_PLACEHOLDER)
+    map_output = None
+    with profiler.span('sass', file=str(source_path)):
+        if source_map:
+            output, map_output = sass.compile(
+                filename=str(source_path),
+                output_style='compressed',
+                source_map_filename=placeholder_path + '.map')
+            output, map_reference = output.rsplit(SOURCE_MAP_REFERENCE, 1)
+        else:
+            output = sass.compile(
+                filename=str(source_path),
+                output_style='compressed')
+    hash = hashlib.sha512(output.encode('utf-8')).hexdigest()[:8]
+    target_path = placeholder_path.replace(HASH_PLACEHOLDER, hash)
+    if source_map:
+        output += SOURCE_MAP_REFERENCE + map_reference.replace(HASH_PLACEHOLDER, hash)
+        map_output = map_output.replace(HASH_PLACEHOLDER, hash)
+    return Path(target_path), output, map_output
+
+
+def compile_sass(source_path, target_path_pattern, source_map=True):
+    """
+    compile_sass compiles the given SCSS file into a hashed CSS file (see
+    render_sass) and returns its path.
+    """
+    target_path, output, map_output = render_sass(
+        source_path, target_path_pattern, source_map)
+    if source_map:
+        write_if_changed(str(target_path) + '.map', map_output)
+    write_if_changed(target_path, output)
+    return target_path
+
+
+def generate_pygments_scss(target_path):
+    """
+    generate_pygments_scss writes the highlighting rules of PYGMENTS_STYLE
+    into target_path, leaving the file alone if they did not change.
+    """
+    import pygments.formatters
+    with profiler.span('pygments-css'):
+        write_if_changed(target_path, pygments.formatters.HtmlFormatter(
+            style=PYGMENTS_STYLE).get_style_defs('.highlight'))
+
+
+def hashed_path(output, target_path_pattern):
+    """
+    hashed_path returns target_path_pattern formatted with a hash of output.
+    """
+    return Path(str(target_path_pattern).format(hashlib.sha512(output.encode('utf-8')).hexdigest()[:8]))
+
+
+def copy_hashed(source_path, target_path_pattern):
+    """
+    copy_hashed copies the given stylesheet to target_path_pattern formatted
+    with a hash of its content and returns the target path.
+    """
+    output = source_path.read_text(encoding='utf-8')
+    target_path = hashed_path(output, target_path_pattern)
+    write_if_changed(target_path, output)
+    return target_path
+
+
+def generate_css(base_folder, target_folder, state=None, source_maps=True,
+                 vendor_folder=None):
+    """
+    generate_css compiles every public SCSS file in base_folder into a hashed
+    CSS file in target_folder and writes a manifest.json with the resulting
+    logical -> hashed name mapping, which is also returned. The stylesheets
+    in vendor_folder are hashed into target_folder as they are.
+    """
+    import pygments
+    import sass
+    log.info("Generating CSS.")
+    state = state or BuildState()
+    target_folder = target_folder
+    try:
+        target_folder.mkdir(parents=True)
+    except FileExistsError:
+        pass
+
+    pygments_css = base_folder / '_pygments.scss'
+    state.run('pygments', [pygments.__version__, PYGMENTS_STYLE],
+              lambda: generate_pygments_scss(pygments_css),
+              outputs=lambda _: [pygments_css], pure=True)
+
+    def outputs(name):
+        paths = [target_folder / name]
+        if source_maps:
+            paths.append(target_folder / (name + '.map'))
+        return paths
+
+    sources = sorted(base_folder.glob('*.scss'))
+    file_mapping = {}
+    for file_ in sources:
+        if not file_.name.startswith('_'):
+            target_path = target_folder / (file_.stem + '.{}.css')
+            file_mapping[file_.name] = state.run(
+                'sass:' + file_.name, [sass.__version__, str(target_path), source_maps] + sources,
+                lambda: compile_sass(file_, target_path, source_maps).name,
+                outputs=outputs, pure=True)
+    vendored = sorted(vendor_folder.glob('*.css')) if vendor_folder is not None else []
+    for file_ in vendored:
+        target_path = target_folder / (file_.name[:-len('.css')] + '.{}.css')
+        file_mapping[file_.name] = state.run(
+            'vendor:' + file_.name, [str(target_path), file_],
+            lambda: copy_hashed(file_, target_path).name,
+            outputs=lambda name: [target_folder / name], pure=True)
+    write_if_changed(target_folder / 'manifest.json',
+                     json.dumps(file_mapping, indent=2, sort_keys=True) + '\n')
+    return file_mapping
+
+
+def minify_html(html):
+    """
+    minify_html removes comments and collapses whitespace outside of pre,
+    script, style and textarea elements. Whitespace is collapsed into a
+    single space rather than dropped, so inline content renders the same.
+    Pygments' empty and whitespace-only token spans are unwrapped as well.
+    """
+    html = re.sub(r'<span></span>|<span class="w">(\s*)</span>', r'\1', html)
+    parts = PRESERVED_ELEMENTS_RE.split(html)
+    minified = []
+    # split returns text, element, element name, text, ...
+    for idx in range(0, len(parts), 3):
+        text = HTML_COMMENT_RE.sub('', parts[idx])
+        minified.append(re.sub(r'\s+', ' ', text))
+        if idx + 1 < len(parts):
+            minified.append(parts[idx + 1])
+    return ''.join(minified).strip()
+
+
+def css_rules(css):
+    """
+    css_rules splits a stylesheet into its top-level rules. Returns a list of
+    (prelude, body) tuples; statements like @import have a body of None.
+    Comments are dropped.
+    """
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.DOTALL)
+    rules = []
+    depth = 0
+    start = brace = 0
+    quote = None
+    idx = 0
+    while idx < len(css):
+        char = css[idx]
+        if quote:
+            if char == '\\':
+                idx += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            if depth == 0:
+                brace = idx
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                rules.append((css[start:brace].strip(), css[brace + 1:idx]))
+                start = idx + 1
+        elif char == ';' and depth == 0:
+            rules.append((css[start:idx].strip(), None))
+            start = idx + 1
+        idx += 1
+    return [rule for rule in rules if rule[0]]
+
+
+def split_selectors(prelude):
+    """
+    split_selectors splits a selector list at the commas that are not part
+    of a functional pseudo class like :not(a, b).
+    """
+    selectors = []
+    depth = 0
+    start = 0
+    for idx, char in enumerate(prelude):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            selectors.append(prelude[start:idx].strip())
+            start = idx + 1
+    selectors.append(prelude[start:].strip())
+    return [selector for selector in selectors if selector]
+
+
+def html_names(html):
+    """
+    html_names returns the element names, classes and ids used in the given
+    HTML.
+    """
+    tags = set(name.lower() for name in re.findall(r'<([a-zA-Z][\w-]*)', html))
+    classes = set()
+    for value in re.findall(r'\sclass="([^"]*)"', html):
+        classes.update(value.split())
+    ids = set(re.findall(r'\sid="([^"]*)"', html))
+    return tags, classes, ids
+
+
+def selector_matches(selector, names):
+    """
+    selector_matches returns whether the given selector may match an element
+    of a document using the given html_names. Attribute selectors and pseudo
+    classes are ignored, so this errs on the side of matching.
+    """
+    tags, classes, ids = names
+    # Drop pseudo classes and elements including their arguments, and
+    # attribute selectors.
+    selector = re.sub(r'::?[\w-]+(\([^)]*\))?|\[[^\]]*\]', '', selector)
+    for compound in re.split(r'\s*[\s>+~]\s*', selector):
+        match = re.match(r'([a-zA-Z][\w-]*|\*)?', compound)
+        tag = match.group(1)
+        if tag and tag != '*' and tag.lower() not in tags:
+            return False
+        if any(name not in classes for name in re.findall(r'\.([\w-]+)', compound)):
+            return False
+        if any(name not in ids for name in re.findall(r'#([\w-]+)', compound)):
+            return False
+    return True
+
+
+def filter_css(css, names):
+    """
+    filter_css returns the given stylesheet reduced to the rules that may
+    apply to a document using the given html_names. Selectors that can't
+    match are removed from their rules; at-rules other than @media and
+    @supports are kept as they are.
+    """
+    output = []
+    for prelude, body in css_rules(css):
+        if body is None:
+            output.append(prelude + ';')
+        elif prelude.startswith(('@media', '@supports')):
+            inner = filter_css(body, names)
+            if inner:
+                output.append('{}{{{}}}'.format(prelude, inner))
+        elif prelude.startswith('@'):
+            output.append('{}{{{}}}'.format(prelude, body))
+        else:
+            selectors = [selector for selector in split_selectors(prelude)
+                         if selector_matches(selector, names)]
+            if selectors:
+                output.append('{}{{{}}}'.format(','.join(selectors), body))
+    return ''.join(output)
+
+
+def rebase_css_urls(css, base):
+    """
+    rebase_css_urls prefixes the relative url()s in css with the folder
+    base, for moving rules out of a stylesheet in that folder.
+    """
+    def rebase(match):
+        quote, url = match.groups()
+        if re.match(r'[a-zA-Z][\w+.-]*:|[/#]', url):
+            return match.group(0)
+        return 'url({0}{1}{0})'.format(quote, posixpath.normpath(posixpath.join(base, url)))
+    return CSS_URL_RE.sub(rebase, css)
+
+
+def inline_critical_css(html, stylesheets):
+    """
+    inline_critical_css inlines the rules of the linked local stylesheets
+    that apply to the first CRITICAL_HTML_SIZE characters of the page and
+    loads the complete stylesheets without blocking the first paint.
+    stylesheets maps the href of every local stylesheet to its CSS. Relative
+    URLs in the inlined rules are rebased onto the page.
+    """
+    names = html_names(html[:CRITICAL_HTML_SIZE])
+    rules = []
+    for href in STYLESHEET_LINK_RE.findall(html):
+        if href in stylesheets:
+            # Statements like @import would block the page again and are
+            # left to the complete stylesheet.
+            rules += ['{}{{{}}}'.format(prelude, rebase_css_urls(body, posixpath.dirname(href)))
+                      for prelude, body in css_rules(filter_css(stylesheets[href], names))
+                      if body is not None]
+    if not rules:
+        return html
+    critical = ''.join(rules)
+
+    def load_async(match):
+        href = match.group(1)
+        if href not in stylesheets:
+            return match.group(0)
+        return ('<link rel="preload" href="{0}" as="style" '
+                'onload="this.onload=null;this.rel=\'stylesheet\'">'
+                '<noscript><link href="{0}" rel="stylesheet"></noscript>').format(href)
+
+    # The critical rules go where the first stylesheet was linked.
+    html = STYLESHEET_LINK_RE.sub(load_async, html)
+    head_end = html.index('<link rel="preload"')
+    return '{}<style>{}</style>{}'.format(html[:head_end], critical, html[head_end:])
+
+
+def purge_stylesheets(pages, style_mapping, css_folder):
+    """
+    purge_stylesheets reduces the given stylesheets to the rules that may
+    apply to any of the given pages (see filter_css), writes them as new
+    hashed files into css_folder and points the pages to them. Returns the
+    updated logical -> hashed name mapping.
+    """
+    names = set(), set(), set()
+    for page in pages:
+        for used, found in zip(names, html_names(Path(page).read_text(encoding='utf-8'))):
+            used.update(found)
+    purged_mapping = {}
+    replacements = []
+    for logical, name in sorted(style_mapping.items()):
+        css = (css_folder / name).read_text(encoding='utf-8')
+        with profiler.span('purge', file=name):
+            purged = filter_css(css, names)
+        hash = hashlib.sha512(purged.encode('utf-8')).hexdigest()[:8]
+        purged_name = '{}.{}.css'.format(name.rsplit('.', 2)[0], hash)
+        write_if_changed(css_folder / purged_name, purged)
+        log.info("Purged %s from %d to %d bytes.", logical, len(css), len(purged))
+        purged_mapping[logical] = purged_name
+        replacements.append(('/{}"'.format(name), '/{}"'.format(purged_name)))
+    for page in pages:
+        html = Path(page).read_text(encoding='utf-8')
+        for old, new in replacements:
+            html = html.replace(old, new)
+        write_if_changed(page, html)
+    return purged_mapping
+
+
+def optimize_page(html, stylesheets):
+    """
+    optimize_page minifies the given page and inlines its critical CSS (see
+    minify_html and inline_critical_css).
+    """
+    with profiler.span('optimize'):
+        return inline_critical_css(minify_html(html), stylesheets)
+
+
+def split_letters(value):
+    return ''.join(['<i>{}</i>'.format(letter) for letter in value])
+
+
+LEXERS = {
+    'python': 'PythonLexer',
+    'rust': 'RustLexer',
+}
+
+
+@lru_cache(maxsize=None)
+def get_lexer(language):
+    import pygments.lexers
+    return getattr(pygments.lexers, LEXERS[language])()
+
+
+@lru_cache(maxsize=None)
+def get_formatter():
+    import pygments.formatters
+    return pygments.formatters.HtmlFormatter()
+
+
+@lru_cache(maxsize=None)
+def get_markdown():
+    import markdown
+    return markdown.Markdown()
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def highlight_code(value, language):
+    """
+    highlight_code highlights value with the shared lexer for the given
+    language and the shared formatter. Results are memoized.
+    """
+    import pygments
+    with profiler.span('highlight', language=language):
+        return pygments.highlight(value, get_lexer(language), get_formatter())
+
+
+def highlight_many(values, language='python'):
+    """
+    highlight_many highlights a batch of snippets in one call and returns the
+    results in the same order.
+    """
+    return [highlight_code(value, language) for value in values]
+
+
+def highlight(value):
+    return highlight_code(value, 'python')
+
+def highlight_rust(value):
+    return highlight_code(value, 'rust')
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def render_markdown(value):
+    converter = get_markdown()
+    converter.reset()
+    with profiler.span('markdown'):
+        return converter.convert(value)
+
+
+class FragmentCache(object):
+    """
+    FragmentCache renders examples through the render_example macro and
+    keeps the resulting HTML on disk. Entries are keyed by the fields of the
+    example and the versions of the macro template and the filters, so
+    unchanged examples are spliced in without being highlighted again.
+    """
+
+    def __init__(self, env, path=None):
+        import pygments
+        self.path = Path(path) if path is not None else FRAGMENT_CACHE_PATH
+        self.macro = env.get_template(FRAGMENT_TEMPLATE).module.render_example
+        source = template_source(env, FRAGMENT_TEMPLATE)
+        self.version = fingerprint([FILTERS_VERSION, pygments.__version__, source])
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, example):
+        from markupsafe import Markup
+        entry = self.path / (fingerprint([self.version, json.dumps(list(example))]) + '.html')
+        self.used.add(entry)
+        try:
+            html = entry.read_text(encoding='utf-8')
+            self.hits += 1
+        except OSError:
+            html = str(self.macro(example))
+            self.path.mkdir(parents=True, exist_ok=True)
+            entry.write_text(html, encoding='utf-8')
+            self.misses += 1
+        return Markup(html)
+
+    def prune(self):
+        """
+        prune removes all fragments that were not used since this cache was
+        created.
+        """
+        if self.path.exists():
+            for entry in self.path.glob('*.html'):
+                if entry not in self.used:
+                    entry.unlink()
+
+
+def precompiled_templates_path(templates_path):
+    """
+    precompiled_templates_path returns where `pyformat precompile` stores the
+    archive for the current state of the given templates folder.
+    """
+    return CACHE_PATH / 'templates-{}.zip'.format(
+        fingerprint([Path(templates_path)])[:16])
+
+
+def create_environment(templates_path='templates', precompiled=True, cache_path=None):
+    """
+    create_environment returns the shared template environment for the given
+    templates folder. Compiled templates are kept in a bytecode cache and, if
+    precompiled is set and `pyformat precompile` was run for the current
+    templates, loaded from the precompiled archive without any parsing.
+    Whether such an archive exists is checked on every call, environments
+    are shared per templates folder, archive and cache folder. The bytecode
+    is kept in cache_path, JINJA_CACHE_PATH by default.
+    """
+    archive = precompiled_templates_path(templates_path) if precompiled else None
+    archive_mtime = mtime(archive) if archive is not None else None
+    if archive_mtime is None:
+        archive = None
+    return _create_environment(str(templates_path), archive and str(archive), archive_mtime,
+                               str(cache_path if cache_path is not None else JINJA_CACHE_PATH))
+
+
+@lru_cache(maxsize=None)
+def _create_environment(templates_path, archive, archive_mtime, jinja_cache_path):
+    import jinja2
+    Path(jinja_cache_path).mkdir(parents=True, exist_ok=True)
+    loader = jinja2.FileSystemLoader(templates_path)
+    if archive is not None:
+        log.info("Using precompiled templates from %s.", archive)
+        loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(archive), loader])
+    env = jinja2.Environment(
+        loader=loader,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(jinja_cache_path))
+    env.filters['markdown'] = render_markdown
+    env.filters['lettering'] = split_letters
+    env.filters['highlight'] = highlight
+    env.filters['highlight_rust'] = highlight_rust
+    return env
+
+
+def template_source(env, name):
+    """
+    template_source returns the source of the given template from the first
+    loader of env that has access to sources.
+    """
+    import jinja2
+    for loader in getattr(env.loader, 'loaders', [env.loader]):
+        if loader.has_source_access:
+            try:
+                return loader.get_source(env, name)[0]
+            except jinja2.TemplateNotFound:
+                pass
+    raise jinja2.TemplateNotFound(name)
+
+
+def load_templates(env):
+    """
+    load_templates compiles (or loads) all templates of the site up front.
+    """
+    for name in TEMPLATES:
+        env.get_template(name)
+
+
+def precompile_templates(templates_path='templates'):
+    """
+    precompile_templates compiles all templates in the given folder into a
+    zip archive of Python modules that create_environment picks up for as
+    long as the templates do not change. Returns the archive path.
+    """
+    archive = precompiled_templates_path(templates_path)
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    env = create_environment(templates_path, precompiled=False)
+    env.compile_templates(str(archive), zip='deflated', ignore_errors=False)
+    return archive
 
-Example = namedtuple("Example", ('name', 'title', 'details', 'setup', 'python_old', 'python_new', 'rust', 'output'))
 
-Version = namedtuple('Version', ('revid', 'datetime', 'language_versions'))
+def paginate(content, reserved=()):
+    """
+    paginate groups the given sections and examples into pages. Every item
+    with a title starts a new page while untitled ones continue the previous
+    page. Pages are named after their first item; names in reserved, like
+    the one of the index page, get a numbered suffix, which can't clash with
+    other names as those are Python identifiers. Returns an ordered page
+    name -> items mapping.
+    """
+    pages = OrderedDict()
+    items = None
+    for item in content:
+        if item.title or items is None:
+            name = item.name
+            suffix = 1
+            while name in reserved or name in pages:
+                suffix += 1
+                name = '{}-{}'.format(item.name, suffix)
+            items = pages[name] = []
+        items.append(item)
+    return pages
 
 
-def unparse(node, strip=None):
-    result = astunparse.unparse(node)
-    if strip:
-        result = result.lstrip().rstrip()
-        if isinstance(node, _ast.BinOp):
-            return result[1:-1]
-    return result
+def page_urls(pages):
+    """
+    page_urls maps the name of every section and example to the file name of
+    the page it ends up on.
+    """
+    urls = {}
+    for page, items in pages.items():
+        for item in items:
+            urls[item.name] = page + '.html'
+            if isinstance(item, Section):
+                for example in item.examples:
+                    urls[example.name] = page + '.html'
+    return urls
 
 
-def generate_laugage_versions():
-    python = "Python version: " + run(["python", "--version"], stdout=PIPE).stdout.decode()
-    rust = "Rust version: " + run(["rustc", "--version"], stdout=PIPE).stdout.decode()
-    return [python, rust]
+def generate_page(env, content, style_mapping, template='index.html',
+                  fragments=None, **context):
+    """
+    generate_page renders the given template for the given content and yields
+    it in chunks as the template produces them, so rendered sections never
+    have to be held in memory all at once. Examples are rendered through the
+    given FragmentCache, the shared one by default; pruning it is left to
+    the build owning it, since other content may have fragments there too.
+    Additional keyword arguments are passed on to the template.
+    """
+    log.info("Rendering %s.", template)
+    tmpl = env.get_template(template)
+    if fragments is None:
+        fragments = FragmentCache(env)
+    if 'version' not in context:
+        context['version'] = generate_version()
+    # The table of contents needs all titles before the first section, so the
+    # parsed records are collected; their rendered HTML is streamed.
+    with profiler.span('render', template=template):
+        for chunk in tmpl.generate(examples=list(content), styles=style_mapping,
+                                   render_fragment=fragments.render, **context):
+            yield chunk
 
-def generate_version():
-    revid = subprocess.check_output(
-        ['git', 'rev-parse', 'HEAD']).decode('utf-8').rstrip()
-    dt = datetime.datetime.utcnow().replace(tzinfo=pytz.UTC)
-    return Version(revid=revid, datetime=dt, language_versions=generate_laugage_versions())
 
+def render_page(env, content, style_mapping):
+    """
+    render_page renders the index page for the given content and returns it.
+    """
+    return ''.join(generate_page(env, content, style_mapping))
 
-def compile_sass(source_path, target_path_pattern):
-    # First generate the content from which we can generate the hashname
-    log.info("Compiling SCSS.")
-    output = sass.compile(
-        filename=str(source_path),
-        output_style='compressed')
+
+def write_pages(env, content, style_mapping, output_file, write=write_chunks,
+                fragments=None, **context):
+    """
+    write_pages writes one page per top-level section or titled example (see
+    paginate) next to output_file, which becomes an index page linking to
+    them. Pages are written with `write` (see write_chunks), examples are
+    rendered through the given FragmentCache. Additional keyword arguments
+    are passed on to the templates. Returns the paths of all written pages.
+    """
+    content = list(content)
+    pages = paginate(content, reserved={output_file.stem})
+    urls = page_urls(pages)
+    version = generate_version()
+    fragments = fragments or FragmentCache(env)
+    paths = [output_file]
+    write(output_file, generate_page(
+        env, content, style_mapping, fragments=fragments, version=version,
+        split=True, page_urls=urls, **context))
+    for name, items in pages.items():
+        path = output_file.parent / (name + '.html')
+        write(path, generate_page(
+            env, items, style_mapping, 'page.html', fragments=fragments,
+            version=version, index_url=output_file.name, **context))
+        paths.append(path)
+    fragments.prune()
+    log.info("Rendered %d pages with %d examples, reused %d cached fragments.",
+             len(paths), fragments.misses, fragments.hits)
+    return paths
+
+
+def search_terms(example):
+    """
+    search_terms returns the words of the title and details of the given
+    example and the format specifiers used in its code.
+    """
+    terms = set()
+    for text in (example.title, example.details):
+        if text:
+            terms.update(word for word in WORD_RE.findall(text.lower()) if len(word) > 1)
+    for code in (example.python_old, example.python_new, example.rust):
+        for _, literal in STRING_LITERAL_RE.findall(code or ''):
+            terms.update(FORMAT_SPEC_RE.findall(literal))
+    return terms
+
+
+def build_search_index(content, urls=None):
+    """
+    build_search_index builds an inverted index over the examples in the
+    given content. Documents are [title, href] pairs, untitled examples
+    inherit the title of the preceding one. Terms are sorted so clients can
+    look up prefixes with a binary search, postings holds the document ids of
+    every term. urls maps example names to the page they are on, see
+    page_urls.
+    """
+    urls = urls or {}
+    docs = []
+    postings = {}
+    title = None
+    for example in iter_examples(content):
+        title = example.title or title or example.name
+        for term in search_terms(example):
+            postings.setdefault(term, []).append(len(docs))
+        docs.append([title, urls.get(example.name, '') + '#' + example.name])
+    terms = sorted(postings)
+    return OrderedDict([
+        ('version', SEARCH_INDEX_VERSION),
+        ('docs', docs),
+        ('terms', terms),
+        ('postings', [postings[term] for term in terms]),
+    ])
+
+
+def write_search_index(index, target_path):
+    """
+    write_search_index writes the given search index as minified JSON into
+    target_path, named after a hash of its content like the stylesheets.
+    Returns the path of the written file.
+    """
+    output = json.dumps(index, ensure_ascii=False, separators=(',', ':'))
     hash = hashlib.sha512(output.encode('utf-8')).hexdigest()[:8]
-    target_path = str(target_path_pattern).format(hash)
-    source_map_target_path = target_path + '.map'
-    output = sass.compile(
-        filename=str(source_path),
-        output_style='compressed',
-        source_map_filename=source_map_target_path)
-    with open(target_path, 'w') as fp:
-        fp.write(output[0])
-    with open(source_map_target_path, 'w') as fp:
-        fp.write(output[1])
-    return Path(target_path)
-
-
-def generate_css(base_folder, target_folder):
-    log.info("Generating CSS.")
-    file_mapping = {}
-    target_folder = target_folder
+    path = target_path / 'search.{}.json'.format(hash)
+    target_path.mkdir(parents=True, exist_ok=True)
+    write_if_changed(path, output)
+    return path
+
+
+def import_brotli():
+    """
+    import_brotli returns the brotli module or None if it isn't installed.
+    """
     try:
-        target_folder.mkdir(parents=True)
-    except FileExistsError:
-        pass
+        import brotli
+    except ImportError:
+        return None
+    return brotli
 
-    pygments_css = base_folder / '_pygments.scss'
-    with open(str(pygments_css), 'w') as fp:
-        fp.write(pygments.formatters.HtmlFormatter().get_style_defs(
-            '.highlight'))
 
-    for file_ in base_folder.glob('*.scss'):
-        if not file_.name.startswith('_'):
-            target_path = target_folder / (file_.stem + '.{}.css')
-            target_path = compile_sass(file_, target_path)
-            file_mapping[file_.name] = target_path.name
-    return file_mapping
+def compress_file(path):
+    """
+    compress_file writes a gzip and, if the brotli module is available, a
+    brotli compressed copy of the given file next to it, both at maximum
+    compression. Returns the paths of the written files.
+    """
+    with profiler.span('compress', path=str(path)):
+        return _compress_file(Path(path))
 
 
-def split_letters(value):
-    return ''.join(['<i>{}</i>'.format(letter) for letter in value])
+def _compress_file(path):
+    brotli = import_brotli()
+    data = path.read_bytes()
+    gzip_path = Path(str(path) + '.gz')
+    with open(str(gzip_path), 'wb') as fp:
+        with gzip.GzipFile(path.name, 'wb', 9, fp, mtime=0) as gzip_fp:
+            gzip_fp.write(data)
+    paths = [gzip_path]
+    if brotli is not None:
+        brotli_path = Path(str(path) + '.br')
+        brotli_path.write_bytes(brotli.compress(data, quality=11))
+        paths.append(brotli_path)
+    return paths
 
 
-def highlight(value):
-    return pygments.highlight(value, pygments.lexers.PythonLexer(),
-                              pygments.formatters.HtmlFormatter())
+def compress_files(paths, state=None):
+    """
+    compress_files precompresses the given files (see compress_file). Files
+    whose content did not change since the last build are skipped. Returns
+    the paths of the compressed files.
+    """
+    state = state or BuildState()
+    compressed = []
+    for path in paths:
+        compressed += state.run('compress:{}'.format(path), [Path(path), import_brotli() is not None],
+                                lambda: [str(p) for p in compress_file(path)],
+                                outputs=lambda paths: paths, pure=True)
+    return compressed
 
-def highlight_rust(value):
-    return pygments.highlight(value, pygments.lexers.RustLexer(),
-                              pygments.formatters.HtmlFormatter())
 
+def remove_stale_pages(previous, current):
+    """
+    remove_stale_pages deletes the pages of a previous build that the
+    current build did not write again, e.g. after a section was renamed,
+    together with their compressed copies.
+    """
+    for path in set(previous) - set(current):
+        if is_page(path):
+            for stale in (Path(path), Path(path + '.gz'), Path(path + '.br')):
+                if stale.exists():
+                    log.info("Removing stale page %s.", stale)
+                    stale.unlink()
 
-def generate_html(content, output_file):
-    log.info("Rendering HTML.")
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader('templates'))
-    env.filters['markdown'] = markdown.markdown
-    env.filters['lettering'] = split_letters
-    env.filters['highlight'] = highlight
-    env.filters['highlight_rust'] = highlight_rust
-    tmpl = env.get_template('index.html')
-    style_mapping = generate_css(Path('assets/sass'), Path('assets/css'))
-    with open(str(output_file), 'w', encoding='utf-8') as fp:
-        fp.write(tmpl.render(examples=list(content), styles=style_mapping,
-                             version=generate_version()))
+
+def remove_stale_compressed(previous, current):
+    """
+    remove_stale_compressed deletes the compressed files of a previous build
+    that the current build did not write again, e.g. when it ran without
+    compression, so no server or deploy picks up an outdated copy.
+    """
+    for path in set(previous) - set(current):
+        if Path(path).exists():
+            log.info("Removing stale compressed file %s.", path)
+            Path(path).unlink()
+
+
+def generate_html(content, output_file, state=None, content_inputs=(),
+                  production=False, split=False, compress=False, optimize=False,
+                  purge=False, site=None):
+    """
+    generate_html renders the given content into output_file. The paths in
+    content_inputs are the files the content was parsed from; together with
+    the templates and styles they decide whether the render stage of an
+    incremental build can be skipped, in which case content is never consumed.
+    Production builds leave out the CSS source maps. With split every section
+    gets its own page and output_file only holds the table of contents. With
+    compress all written files are precompressed as well. A search index over
+    the examples is written next to the stylesheets. site holds the
+    SitePaths to use, DEFAULT_SITE_PATHS by default. With optimize the pages
+    are minified and their critical CSS is inlined (see optimize_page). With
+    purge the pages link stylesheets stripped of the rules none of them use
+    (see purge_stylesheets), which come without source maps.
+    Returns the paths of all files that make up the site.
+    """
+    state = state or BuildState()
+    site = site or DEFAULT_SITE_PATHS
+    previous_compressed = [path for name, stage in state.stages.items()
+                           if name.startswith('compress:') for path in stage['outputs']]
+    style_mapping = generate_css(site.sass, site.css, state=state,
+                                 source_maps=not production, vendor_folder=site.vendor)
+
+    def write(path, chunks):
+        if optimize:
+            stylesheets = {}
+            for name in style_mapping.values():
+                css_path = site.css / name
+                stylesheets[css_path.as_posix()] = css_path.read_text(encoding='utf-8')
+            chunks = [optimize_page(''.join(chunks), stylesheets)]
+        write_chunks(path, chunks)
+
+    def render():
+        env = create_environment(site.templates, cache_path=site.cache and site.cache / 'jinja')
+        with state.timed('templates'):
+            load_templates(env)
+        fragments = FragmentCache(env, site.cache and site.cache / 'fragments')
+        items = list(content)
+        urls = page_urls(paginate(items, reserved={output_file.stem})) if split else None
+        with state.timed('search'):
+            search_path = write_search_index(build_search_index(items, urls), site.search)
+        search_index = '{}/{}'.format(site.search.as_posix(), search_path.name)
+        if split:
+            paths = write_pages(env, items, style_mapping, output_file, write=write,
+                                fragments=fragments, search_index=search_index)
+        else:
+            write(output_file, generate_page(env, items, style_mapping, fragments=fragments,
+                                             search_index=search_index))
+            fragments.prune()
+            log.info("Rendered %d examples, reused %d cached fragments.",
+                     fragments.misses, fragments.hits)
+            paths = [output_file]
+        return [str(path) for path in paths] + [str(search_path)]
+
+    inputs = [Path(__file__), site.templates, json.dumps(style_mapping, sort_keys=True),
+              generate_revid(), str(output_file), split, optimize,
+              # purge_stylesheets rewrites the rendered pages.
+              purge] + list(content_inputs)
+    previous = state.stages.get('render', {}).get('result') or []
+    paths = list(state.run('render', inputs, render, outputs=lambda paths: paths))
+    remove_stale_pages(previous, paths)
+    if purge:
+        with state.timed('purge'):
+            style_mapping = purge_stylesheets(
+                [path for path in paths if is_page(path)], style_mapping, site.css)
+    for name in style_mapping.values():
+        paths.append(str(site.css / name))
+        if not production and (site.css / (name + '.map')).exists():
+            paths.append(str(site.css / (name + '.map')))
+    compressed = []
+    if compress:
+        log.info("Compressing output.")
+        compressed = compress_files(paths, state=state)
+    remove_stale_compressed(previous_compressed, compressed)
+    return paths + compressed
+
+
+def file_digest(path):
+    """
+    file_digest returns the sha256 hex digest of the content of path.
+    """
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def build_manifest(paths, root='.'):
+    """
+    build_manifest maps the given files, relative to root, to a hash of their
+    content.
+    """
+    root = Path(root).resolve()
+    manifest = []
+    for path in paths:
+        try:
+            name = Path(path).resolve().relative_to(root).as_posix()
+        except ValueError:
+            raise ValueError("{} is outside of the site folder {}".format(path, root))
+        manifest.append((name, file_digest(path)))
+    return OrderedDict(sorted(manifest))
+
+
+def read_manifest(path):
+    """
+    read_manifest returns the manifest stored at path or an empty one.
+    """
+    try:
+        with open(str(path), encoding='utf-8') as fp:
+            return json.load(fp, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return OrderedDict()
+
+
+def write_manifest(path, manifest):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(path), 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp, indent=1)
+
+
+def record_build(manifest, history_path=None, keep=MANIFEST_HISTORY_SIZE):
+    """
+    record_build adds the given build manifest to the manifest history and
+    drops all but the `keep` previous ones. Rebuilding an earlier state
+    moves its manifest to the front again.
+    """
+    history_path = Path(history_path) if history_path is not None else MANIFEST_HISTORY_PATH
+    digest = fingerprint([json.dumps(manifest, sort_keys=True)])[:16]
+    for entry in history_path.glob('*-{}.json'.format(digest)):
+        entry.unlink()
+    write_manifest(history_path / '{:020d}-{}.json'.format(int(time.time() * 1e6), digest), manifest)
+    for entry in sorted(history_path.glob('*.json'), reverse=True)[keep + 1:]:
+        entry.unlink()
+
+
+def manifest_history(history_path=None):
+    """
+    manifest_history returns the recorded build manifests, newest first.
+    """
+    history_path = Path(history_path) if history_path is not None else MANIFEST_HISTORY_PATH
+    return [read_manifest(entry) for entry in sorted(history_path.glob('*.json'), reverse=True)]
+
+
+def collect_garbage(manifests, folders=HASHED_ASSET_PATHS, root='.', dry_run=False):
+    """
+    collect_garbage removes the hashed assets in the given folders that are
+    not part of any of the given build manifests (or sets of relative
+    paths). Returns the paths of the removed files, which are only listed
+    with dry_run.
+    """
+    root = Path(root)
+    keep = set()
+    for manifest in manifests:
+        keep.update(manifest)
+    garbage = []
+    for folder in folders:
+        if not (root / folder).is_dir():
+            continue
+        for path in sorted((root / folder).iterdir()):
+            if path.is_file() and HASHED_ASSET_RE.search(path.name) \
+                    and path.relative_to(root).as_posix() not in keep:
+                garbage.append(path)
+    if not dry_run:
+        for path in garbage:
+            path.unlink()
+    return garbage
+
+
+def is_page(name):
+    """
+    is_page returns whether name is an HTML page or a compressed copy of one.
+    """
+    return name.endswith(('.html', '.html.gz', '.html.br'))
+
+
+def plan_deploy(manifest, deployed):
+    """
+    plan_deploy returns the files of manifest that are new or changed
+    compared to the deployed manifest. Assets come before the pages so no
+    page is served before the hashed files it references.
+    """
+    changed = [name for name, digest in manifest.items() if deployed.get(name) != digest]
+    return sorted(changed, key=is_page)
+
+
+class LocalTarget(object):
+    """
+    LocalTarget deploys into a local folder. The manifest of the last deploy
+    is kept in DEPLOY_MANIFEST_NAME inside of it.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def read_manifest(self):
+        return read_manifest(self.path / DEPLOY_MANIFEST_NAME)
+
+    def put(self, source, name):
+        target = self.path / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(target.name + '.tmp')
+        shutil.copyfile(str(source), str(tmp))
+        os.replace(str(tmp), str(target))
+
+    def write_manifest(self, manifest):
+        write_manifest(self.path / DEPLOY_MANIFEST_NAME, manifest)
+
+
+def deploy_build(manifest, target, root='.', dry_run=False):
+    """
+    deploy_build transfers the files of the given build manifest that
+    changed since the last deploy to target (see plan_deploy) and then
+    records the manifest there. Returns the names of the transferred files.
+    """
+    names = plan_deploy(manifest, target.read_manifest())
+    if dry_run:
+        return names
+    for name in names:
+        log.info("Deploying %s.", name)
+        target.put(Path(root) / name, name)
+    target.write_manifest(manifest)
+    return names
+
+
+def snapshot(paths):
+    """
+    snapshot returns the modification time of every file below the given
+    paths.
+    """
+    mtimes = {}
+    for path in paths:
+        for file_ in (path.rglob('*') if path.is_dir() else [path]):
+            if file_.is_file():
+                mtimes[file_] = file_.stat().st_mtime_ns
+    return mtimes
+
+
+class LiveSite(object):
+    """
+    LiveSite keeps a rendered copy of the site in memory. rebuild only
+    recompiles the styles, re-parses the content or reloads the templates if
+    one of their files changed, and then renders the page again. The
+    stylesheets in vendor_path are served hashed next to the compiled ones,
+    as in generate_css.
+    """
+
+    def __init__(self, content_path, templates_path, sass_path, vendor_path=None):
+        self.content_path = Path(content_path)
+        self.templates_path = Path(templates_path)
+        self.sass_path = Path(sass_path)
+        self.vendor_path = Path(vendor_path) if vendor_path is not None else None
+        self.files = {}
+        self.generation = 0
+        self.content = None
+        self.styles = None
+        self.env = None
+
+    def watched_paths(self):
+        paths = [self.content_path, self.templates_path, self.sass_path]
+        return paths + [self.vendor_path] if self.vendor_path is not None else paths
+
+    def build_css(self):
+        generate_pygments_scss(self.sass_path / '_pygments.scss')
+        styles = {}
+        for file_ in sorted(self.sass_path.glob('*.scss')):
+            if not file_.name.startswith('_'):
+                target_path, output, _ = render_sass(
+                    file_, file_.stem + '.{}.css', source_map=False)
+                self.files['/assets/css/' + target_path.name] = (
+                    'text/css', output.encode('utf-8'))
+                styles[file_.name] = target_path.name
+        vendored = sorted(self.vendor_path.glob('*.css')) if self.vendor_path is not None else []
+        for file_ in vendored:
+            output = file_.read_text(encoding='utf-8')
+            target_path = hashed_path(output, file_.name[:-len('.css')] + '.{}.css')
+            self.files['/assets/css/' + target_path.name] = ('text/css', output.encode('utf-8'))
+            styles[file_.name] = target_path.name
+        self.styles = styles
+
+    def build_html(self):
+        html = render_page(self.env, self.content, self.styles)
+        html = html.replace('</body>', LIVE_RELOAD_SCRIPT + '</body>')
+        self.files['/'] = self.files['/index.html'] = (
+            'text/html; charset=utf-8', html.encode('utf-8'))
+
+    def rebuild(self, changed=None):
+        """
+        rebuild updates the site for the given changed files or completely if
+        changed is None. Errors are logged and leave the last good build in
+        place.
+        """
+        start = time.perf_counter()
+        def touched(path):
+            return changed is None or any(
+                file_ == path or path in file_.parents for file_ in changed)
+        try:
+            if touched(self.sass_path) or (self.vendor_path and touched(self.vendor_path)):
+                self.build_css()
+            if touched(self.content_path):
+                self.content = list(get_content(self.content_path))
+            if touched(self.templates_path):
+                self.env = create_environment(self.templates_path, precompiled=False)
+            self.build_html()
+        except Exception:
+            log.exception("Rebuild failed.")
+            return False
+        self.generation += 1
+        log.info("Rebuilt in %.0fms.", (time.perf_counter() - start) * 1000)
+        return True
+
+    def watch(self, interval):
+        """
+        watch polls the watched paths every `interval` seconds and rebuilds
+        the site whenever a file changes.
+        """
+        mtimes = snapshot(self.watched_paths())
+        while True:
+            time.sleep(interval)
+            current = snapshot(self.watched_paths())
+            changed = {file_ for file_ in set(mtimes) | set(current)
+                       if mtimes.get(file_) != current.get(file_)}
+            # The pygments stylesheet is written by build_css itself.
+            changed.discard(self.sass_path / '_pygments.scss')
+            mtimes = current
+            if changed:
+                log.info("Changed: %s", ', '.join(sorted(map(str, changed))))
+                self.rebuild(changed)
+
+
+def create_server(site, port):
+    """
+    create_server returns an HTTP server that serves the in-memory files of
+    the given LiveSite and everything else from the working directory.
+    """
+    import http.server
+    import socketserver
+
+    class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == '/__generation':
+                self.send_body('text/plain', str(site.generation).encode('utf-8'))
+            elif path in site.files:
+                self.send_body(*site.files[path])
+            else:
+                super().do_GET()
+
+        def send_body(self, content_type, body):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    return ThreadingHTTPServer(('127.0.0.1', port), Handler)
 
 
 def parse_docstring(docstring):
@@ -138,7 +2088,17 @@ def parse_docstring(docstring):
         return (None, '\n'.join(lines) or None)
 
 
-def parse_function(node):
+def parse_function(node, source=None):
+    """
+    parse_function parses the given node representing a test function into an
+    Example. If a SourceSlicer for the module is given, code is taken
+    verbatim from the source, otherwise it is regenerated from the AST.
+    """
+    def extract(node):
+        if source is not None:
+            return source.node(node)
+        return unparse(node, strip=True)
+
     old_style = None
     new_style = None
     rust_style = None
@@ -150,26 +2110,31 @@ def parse_function(node):
 
     for n in node.body:
         # Ignore the docstring
-        if isinstance(n, _ast.Expr) and isinstance(n.value, _ast.Str):
+        if isinstance(n, _ast.Expr) and literal_string(n.value) is not None:
             continue
         if isinstance(n, _ast.Assign) and n.targets[0].id == 'old_result':
             setup_done = True
-            old_style = unparse(n.value, strip=True)
+            old_style = extract(n.value)
         if isinstance(n, _ast.Assign) and n.targets[0].id == 'new_result':
             setup_done = True
-            new_style = unparse(n.value, strip=True)
+            new_style = extract(n.value)
         if isinstance(n, _ast.Assign) and n.targets[0].id == 'rust_result':
             setup_done = True
-            rust_style = unparse(n.value, strip=True).strip("'")
-        if isinstance(n, _ast.Assert) and isinstance(
-                n.test.comparators[0], _ast.Str):
+            rust_style = literal_string(n.value)
+            if rust_style is None:
+                rust_style = extract(n.value).strip("'")
+        if isinstance(n, _ast.Assert) and literal_string(
+                n.test.comparators[0]) is not None:
             setup_done = True
-            output = n.test.comparators[0].s
+            output = literal_string(n.test.comparators[0])
         if not setup_done:
             setup.append(n)
 
     if setup:
-        setup = unparse(setup, strip=True)
+        if source is not None:
+            setup = source.statements(setup)
+        else:
+            setup = unparse(setup, strip=True)
 
     return Example(
         name,
@@ -183,10 +2148,11 @@ def parse_function(node):
     )
 
 
-def parse_class(node):
+def parse_class(node, source=None):
     """
     parse_class parses the given node representing a test class for example
-    test cases and puts everything into a Section object.
+    test cases and puts everything into a Section object. source is passed on
+    to parse_function.
     """
     name = node.name[4:]
     title, details = parse_docstring(ast.get_docstring(node))
@@ -194,28 +2160,320 @@ def parse_class(node):
 
     for n in node.body:
         if isinstance(n, _ast.FunctionDef) and n.name.startswith('test_'):
-            example = parse_function(n)
+            example = parse_function(n, source)
             examples.append(example._replace(
                 name='{}__{}'.format(name, example.name)))
 
     return Section(name, title, details, examples)
 
 
-def get_content(filename=None):
+class ParseCache(object):
     """
-    get_content generates sections or examples out of the given file path.
+    ParseCache keeps the sections and examples parsed out of every content
+    module on disk. There is one entry per module, valid as long as the
+    content of the module, the parser version and the Python version (which
+    decides how source is extracted) stay the same.
     """
-    log.info("Parsing content.")
-    if filename is None:
-        filename = CONTENT_MODULE_PATH
-    with open(str(filename), encoding='utf-8') as fp:
-        source = fp.read()
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path is not None else PARSE_CACHE_PATH
+
+    def _entry_path(self, filename):
+        return self.path / (fingerprint([Path(filename).resolve()])[:16] + '.json')
+
+    def _key(self, filename):
+        return fingerprint([PARSER_VERSION, sys.version_info[:2], Path(filename)])
+
+    def get(self, filename):
+        try:
+            with open(str(self._entry_path(filename)), encoding='utf-8') as fp:
+                data = json.load(fp)
+            if data['key'] != self._key(filename):
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return [import_record(record) for record in data['items']]
+
+    def set(self, filename, items):
+        entry = self._entry_path(filename)
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_suffix('.tmp')
+        with open(str(tmp), 'w', encoding='utf-8') as fp:
+            json.dump({'key': self._key(filename),
+                       'items': [export_record(item) for item in items]}, fp)
+        os.replace(str(tmp), str(entry))
+
+
+def content_files(sources=None, order='path'):
+    """
+    content_files resolves the given content sources into a list of content
+    modules. A source is a file, a directory whose CONTENT_MODULE_PATTERN
+    files are used or a glob pattern; sources defaults to
+    CONTENT_MODULE_PATH. See CONTENT_ORDERS for the possible orders.
+    """
+    if order not in CONTENT_ORDERS:
+        raise ValueError("Unknown content order {!r}".format(order))
+    if sources is None:
+        sources = [CONTENT_MODULE_PATH]
+    elif isinstance(sources, (str, Path)):
+        sources = [sources]
+    files = []
+    for source in sources:
+        path = Path(source)
+        if path.is_dir():
+            matches = sorted(path.glob(CONTENT_MODULE_PATTERN))
+        elif any(char in str(source) for char in '*?['):
+            matches = sorted(Path(match) for match in glob(str(source), recursive=True))
+        else:
+            matches = [path]
+        files.extend(match for match in matches if match not in files)
+    return sorted(files) if order == 'path' else files
+
+
+def get_content(filename=None, jobs=1, order='path', cache=None):
+    """
+    get_content generates sections or examples out of the given content
+    sources (see content_files). Modules found in the given ParseCache are
+    not parsed again, the others are parsed on up to `jobs` processes. The
+    results are merged in the order of the modules.
+    """
+    files = content_files(filename, order)
+    parsed = OrderedDict((file_, cache.get(file_) if cache else None) for file_ in files)
+    missing = [file_ for file_, items in parsed.items() if items is None]
+    log.info("Parsing content from %d modules, %d cached.",
+             len(files), len(files) - len(missing))
+    jobs = max(1, min(jobs, len(missing)))
+    if jobs == 1:
+        results = map(parse_module, missing)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(parse_module, missing))
+    for file_, items in zip(missing, results):
+        parsed[file_] = items
+        if cache:
+            cache.set(file_, items)
+    for items in parsed.values():
+        for item in items:
+            yield item
+
+
+def parse_module(filename):
+    """
+    parse_module returns the sections and examples of the given content
+    module.
+    """
+    return list(_parse_module(filename))
+
+
+def _parse_module(filename):
+    with profiler.span('parse', file=str(filename)):
+        with open(str(filename), 'rb') as fp:
+            source = fp.read()
         module = ast.parse(source)
-        for node in module.body:
-            if isinstance(node, _ast.FunctionDef) and node.name.startswith('test_'):
-                yield parse_function(node)
-            if isinstance(node, _ast.ClassDef) and node.name.startswith('Test'):
-                yield parse_class(node)
+        slicer = SourceSlicer(source) if SourceSlicer.supported() else None
+    for node in module.body:
+        if isinstance(node, _ast.FunctionDef) and node.name.startswith('test_'):
+            with profiler.span('extract', example=node.name):
+                example = parse_function(node, slicer)
+            yield example
+        if isinstance(node, _ast.ClassDef) and node.name.startswith('Test'):
+            with profiler.span('extract', example=node.name):
+                section = parse_class(node, slicer)
+            yield section
+
+
+def iter_examples(content):
+    """
+    iter_examples flattens the given sections and examples into examples.
+    """
+    for item in content:
+        if isinstance(item, Section):
+            for example in item.examples:
+                yield example
+        else:
+            yield item
+
+
+def filter_content(content, sections=(), names=()):
+    """
+    filter_content keeps the sections whose name matches one of the given
+    section globs and the examples whose name matches one of the given name
+    globs. Sections without any matching example are dropped. Empty filters
+    match everything; top-level examples never match a section filter.
+    """
+    def matches(name, patterns):
+        return not patterns or any(fnmatchcase(name, pattern) for pattern in patterns)
+
+    for item in content:
+        if isinstance(item, Section):
+            if not matches(item.name, sections):
+                continue
+            examples = [example for example in item.examples
+                        if matches(example.name, names)]
+            if examples:
+                yield item._replace(examples=examples)
+        elif not sections and matches(item.name, names):
+            yield item
+
+
+def export_record(item):
+    """
+    export_record converts a section or an example into a JSON serializable
+    dict, tagged with its type.
+    """
+    if isinstance(item, Section):
+        record = OrderedDict([('type', 'section')])
+        record.update(item._asdict())
+        record['examples'] = [export_record(example) for example in item.examples]
+        return record
+    record = OrderedDict([('type', 'example')])
+    record.update(item._asdict())
+    return record
+
+
+def import_record(record):
+    """
+    import_record turns a record written by export_record back into a
+    section or an example.
+    """
+    fields = dict(record)
+    if fields.pop('type') == 'section':
+        fields['examples'] = [import_record(example) for example in fields['examples']]
+        return Section(**fields)
+    return Example(**fields)
+
+
+def export_content(content, fmt='jsonl'):
+    """
+    export_content generates the given content as compact JSON Lines, one
+    section or example per line, or as a single minified JSON document.
+    """
+    dumps = lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    if fmt == 'jsonl':
+        for item in content:
+            yield dumps(export_record(item)) + '\n'
+        return
+    yield '['
+    for idx, item in enumerate(content):
+        yield (',' if idx else '') + dumps(export_record(item))
+    yield ']\n'
+
+
+def generate_synthetic_content(examples, sections=0):
+    """
+    generate_synthetic_content returns the source of a valid content module
+    with the given number of examples. Examples are spread round-robin over
+    top-level test functions and the given number of test classes.
+    """
+    functions = []
+    classes = [[] for _ in range(sections)]
+    for idx in range(examples):
+        width = idx % 12 + 1
+        function = SYNTHETIC_EXAMPLE_TEMPLATE.format(
+            idx=idx, width=width, expected=str(idx).rjust(width))
+        group = idx % (sections + 1)
+        if group == 0:
+            functions.append(function)
+        else:
+            classes[group - 1].append(indent(function.replace('():', '(self):', 1), ' ' * 4))
+    source = '\n\n'.join(functions)
+    for idx, methods in enumerate(classes):
+        source += '\n\n' + SYNTHETIC_SECTION_TEMPLATE.format(idx=idx)
+        source += '\n'.join(methods) or '    pass\n'
+    return source
+
+
+def time_best(func, repeat):
+    """
+    time_best calls func `repeat` times and returns the fastest duration.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def benchmark_size(path, repeat, stages=BENCHMARK_STAGES):
+    """
+    benchmark_size times the given stages of the build pipeline on the
+    content module at path and returns a stage -> seconds mapping.
+    """
+    results = OrderedDict()
+    with open(str(path), 'rb') as fp:
+        source = fp.read()
+    slicer = SourceSlicer(source) if SourceSlicer.supported() else None
+    functions = [node for node in ast.walk(ast.parse(source))
+                 if isinstance(node, _ast.FunctionDef) and node.name.startswith('test_')]
+    content = list(get_content(path))
+    examples = [example for item in content
+                for example in (item.examples if isinstance(item, Section) else [item])]
+    with TemporaryDirectory(prefix='pyformat-bench-') as scratch_dir:
+        scratch_dir = Path(scratch_dir)
+        here = Path(__file__).parent
+        # The styles are copied as generate_css writes _pygments.scss next to
+        # them; everything else is written into the scratch folder as well.
+        copytree(str(here / 'assets' / 'sass'), str(scratch_dir / 'sass'))
+        site = SitePaths(templates=here / 'templates', sass=scratch_dir / 'sass',
+                         css=scratch_dir / 'css', search=scratch_dir / 'search',
+                         vendor=None, cache=scratch_dir / 'cache')
+
+        def highlight_all():
+            highlight_code.cache_clear()
+            highlight_many([e.python_old for e in examples] + [e.python_new for e in examples])
+            highlight_many([e.rust for e in examples], 'rust')
+
+        def render():
+            for entry in site.cache.glob('fragments/*'):
+                entry.unlink()
+            highlight_code.cache_clear()
+            render_markdown.cache_clear()
+            generate_html(content, scratch_dir / 'index.html', site=site)
+
+        benchmarks = {
+            'get_content': lambda: list(get_content(path)),
+            'parse_function': lambda: [parse_function(node, slicer) for node in functions],
+            'generate_css': lambda: generate_css(site.sass, site.css),
+            'highlight': highlight_all,
+            'generate_html': render,
+        }
+        for stage in stages:
+            results[stage] = time_best(benchmarks[stage], repeat)
+    return results
+
+
+def run_benchmarks(sizes, repeat=3, stages=BENCHMARK_STAGES):
+    """
+    run_benchmarks generates a synthetic content module for every size (with
+    one section per ten examples) and times the build pipeline on it.
+    Returns the results in the format written by `pyformat bench`.
+    """
+    results = OrderedDict()
+    with TemporaryDirectory(prefix='pyformat-bench-') as scratch_dir:
+        for size in sizes:
+            path = Path(scratch_dir) / 'test_content_{}.py'.format(size)
+            with open(str(path), 'w', encoding='utf-8') as fp:
+                fp.write(generate_synthetic_content(size, size // 10))
+            log.info("Benchmarking %d examples.", size)
+            results[str(size)] = benchmark_size(path, repeat, stages)
+    return {'python': sys.version.split()[0], 'results': results}
+
+
+def compare_benchmarks(baseline, current, tolerance=BENCHMARK_TOLERANCE):
+    """
+    compare_benchmarks returns (size, stage, baseline, current) for every
+    stage that got slower than the baseline by more than tolerance (a
+    fraction of the baseline time).
+    """
+    regressions = []
+    for size, stages in current['results'].items():
+        for stage, duration in stages.items():
+            before = baseline['results'].get(size, {}).get(stage)
+            if before is not None and duration > before * (1 + tolerance):
+                regressions.append((size, stage, before, duration))
+    return regressions
 
 
 @click.group()
@@ -226,17 +2484,229 @@ def main():
 @main.command()
 @click.option('-o', '--output', default='index.html',
               help="Path to the output HTML file")
-def generate(output):
-    generate_html(get_content(), Path(output))
+@click.option('--check-rust', is_flag=True,
+              help="Evaluate all Rust snippets and compare them with the output")
+@click.option('-c', '--content', 'sources', multiple=True,
+              help="Content module, directory or glob, defaults to {}".format(CONTENT_MODULE_PATH))
+@click.option('--content-order', type=click.Choice(CONTENT_ORDERS), default='path',
+              help="Order in which the content modules are merged")
+@click.option('-j', '--jobs', default=1, type=int,
+              help="Number of parallel processes for parsing and Rust compilations")
+@click.option('-i', '--incremental', is_flag=True,
+              help="Skip stages whose inputs did not change since the last build")
+@click.option('--production', is_flag=True,
+              help="Leave out source maps")
+@click.option('--split', is_flag=True,
+              help="Write one page per section next to an index page")
+@click.option('--compress', is_flag=True,
+              help="Write gzip and brotli compressed copies of the output")
+@click.option('--profile', is_flag=True,
+              help="Record timings and write them as a Chrome trace")
+@click.option('--cprofile', is_flag=True,
+              help="Write a cProfile dump for every build stage (implies --profile)")
+@click.option('--keep', default=MANIFEST_HISTORY_SIZE, type=int,
+              help="Number of previous builds whose assets are kept")
+@click.option('--optimize', is_flag=True,
+              help="Minify the pages and inline their critical CSS")
+@click.option('--purge', is_flag=True,
+              help="Drop the CSS rules the pages don't use")
+def generate(output, sources, content_order, check_rust, jobs, incremental, production,
+             split, compress, profile, cprofile, keep, optimize, purge):
+    if Path.cwd() not in Path(output).resolve().parents:
+        # The pages link the assets relative to the working directory, which
+        # is also the root the build manifest and deploy work from.
+        raise click.BadParameter("must be inside the current folder", param_hint="'-o' / '--output'")
+    if profile or cprofile:
+        profiler.enable(PROFILE_PATH / 'cprofile' if cprofile else None)
+    state = BuildState(BUILD_STATE_PATH, incremental=incremental)
+    sources = sources or None
+    content = get_content(sources, jobs=jobs, order=content_order, cache=ParseCache())
+    if check_rust:
+        content = list(content)
+        check_rust_outputs(content, jobs=jobs)
+    paths = generate_html(content, Path(output), state=state,
+                          content_inputs=content_files(sources, content_order) + [content_order],
+                          production=production, split=split, compress=compress,
+                          optimize=optimize, purge=purge)
+    manifest = build_manifest(paths)
+    write_manifest(BUILD_MANIFEST_PATH, manifest)
+    record_build(manifest, keep=keep)
+    with state.timed('gc'):
+        # Stage outputs that aren't part of the site, like the stylesheets
+        # before purging, are kept so the next build can reuse them.
+        removed = collect_garbage(manifest_history() + [state.outputs()])
+    if removed:
+        log.info("Removed %d unused assets.", len(removed))
+    state.save()
+    state.report()
+    if profiler.enabled:
+        profiler.write_trace(PROFILE_PATH / 'trace.json')
+        log.info("Wrote trace to %s.", PROFILE_PATH / 'trace.json')
+        print("{:<16} {:>7} {:>10} {:>10}".format('span', 'count', 'total', 'max'))
+        for name, count, total, longest in profiler.summary():
+            print("{:<16} {:>7} {:>9.4f}s {:>9.4f}s".format(name, count, total, longest))
     log.info("Done.")
 
 
 @main.command()
+@click.option('-p', '--port', default=8000, help="Port to listen on")
+@click.option('--interval', default=0.1,
+              help="Seconds between checks for changed files")
+def serve(port, interval):
+    site = LiveSite(CONTENT_MODULE_PATH, Path('templates'), Path('assets/sass'), VENDOR_PATH)
+    site.rebuild()
+    server = create_server(site, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving on http://127.0.0.1:%d/", port)
+    try:
+        site.watch(interval)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+@main.command()
+def precompile():
+    log.info("Precompiled templates into %s.", precompile_templates())
+
+
+@main.command()
+@click.option('--sizes', default='10,100,1000',
+              help="Comma separated numbers of examples to benchmark")
+@click.option('-r', '--repeat', default=3, help="Runs per stage, the best one counts")
+@click.option('-o', '--output', default=None, help="Write the results to this JSON file")
+@click.option('--save', is_flag=True, help="Store the results as the new baseline")
+@click.option('--compare', is_flag=True, help="Flag regressions against the baseline")
+@click.option('--baseline', default=str(BENCHMARK_BASELINE_PATH),
+              help="Path of the baseline JSON file")
+def bench(sizes, repeat, output, save, compare, baseline):
+    results = run_benchmarks([int(size) for size in sizes.split(',')], repeat)
+    for size, stages in results['results'].items():
+        print("{} examples:".format(size))
+        for stage, duration in stages.items():
+            print("    {:<16} {:9.4f}s".format(stage, duration))
+    if output:
+        with open(output, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+    if save:
+        Path(baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=2)
+    if compare:
+        with open(baseline, encoding='utf-8') as fp:
+            regressions = compare_benchmarks(json.load(fp), results)
+        for size, stage, before, after in regressions:
+            print("REGRESSION {} examples {}: {:.4f}s -> {:.4f}s".format(
+                size, stage, before, after))
+        if regressions:
+            sys.exit(1)
+
+
+@main.group()
+def cache():
+    """
+    Inspect or clear the Rust snippet cache.
+    """
+
+
+@cache.command()
+def stats():
+    stats = RustCache().stats()
+    print("Path: {}".format(stats['path']))
+    print("Entries: {}".format(stats['entries']))
+    print("Size: {} bytes".format(stats['size']))
+    if stats['entries']:
+        now = time.time()
+        print("Oldest: {:.0f}s ago".format(now - stats['oldest']))
+        print("Newest: {:.0f}s ago".format(now - stats['newest']))
+
+
+@cache.command()
+def clear():
+    print("Removed {} entries.".format(RustCache().clear()))
+
+
+def fetch_vendor_asset(url, sha256):
+    """
+    fetch_vendor_asset downloads url and returns its content. Raises a
+    ValueError unless the content has the given sha256 digest.
+    """
+    from urllib.request import urlopen
+    log.info("Downloading %s.", url)
+    with urlopen(url) as response:
+        data = response.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if sha256 is None:
+        raise ValueError("{} is not pinned, its sha256 is {}.".format(url, digest))
+    if digest != sha256:
+        raise ValueError("{} has sha256 {}, expected {}.".format(url, digest, sha256))
+    return data
+
+
+@main.command()
+def vendor():
+    """
+    Download the third-party stylesheets into the vendor folder.
+    """
+    downloads = []
+    for name, (url, sha256) in VENDOR_ASSETS.items():
+        try:
+            downloads.append((name, fetch_vendor_asset(url, sha256)))
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    VENDOR_PATH.mkdir(parents=True, exist_ok=True)
+    for name, data in downloads:
+        (VENDOR_PATH / name).write_bytes(data)
+    print("Vendored {} stylesheets into {}.".format(len(VENDOR_ASSETS), VENDOR_PATH))
+
+
+@main.command()
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Only list the files that would be removed")
+def gc(dry_run):
+    """
+    Remove hashed assets that none of the recorded builds use.
+    """
+    manifests = manifest_history()
+    if not manifests:
+        raise click.ClickException("No builds recorded, run `pyformat generate` first.")
+    manifests.append(BuildState(BUILD_STATE_PATH).outputs())
+    garbage = [(path, path.stat().st_size) for path in collect_garbage(manifests, dry_run=True)]
+    for path, size in garbage:
+        print("{} ({} bytes)".format(path, size))
+    if not dry_run:
+        collect_garbage(manifests)
+    print("{} {} files, {} bytes.".format("Would remove" if dry_run else "Removed",
+                                          len(garbage), sum(size for _, size in garbage)))
+
+
+@main.command()
+@click.argument('target', type=click.Path(file_okay=False))
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Only list the files that would be transferred")
+def deploy(target, dry_run):
+    """
+    Deploy the last build into the TARGET folder.
+    """
+    manifest = read_manifest(BUILD_MANIFEST_PATH)
+    if not manifest:
+        raise click.ClickException("No build found, run `pyformat generate` first.")
+    names = deploy_build(manifest, LocalTarget(target), dry_run=dry_run)
+    for name in names:
+        print(name)
+    print("{} {} of {} files.".format("Would transfer" if dry_run else "Transferred",
+                                      len(names), len(manifest)))
+
+
+@main.command()
+@click.option('-c', '--content', 'sources', multiple=True,
+              help="Content module, directory or glob, defaults to {}".format(CONTENT_MODULE_PATH))
+@click.option('-j', '--jobs', default=1, type=int,
+              help="Number of parallel parsing processes")
 @click.option('-v', '--verbose', is_flag=True,
               help="Print function definitions")
-def extract(verbose):
+def extract(sources, jobs, verbose):
     cnt = 0
-    for example in get_content():
+    for example in iter_examples(get_content(sources or None, jobs=jobs, cache=ParseCache())):
         cnt += 1
         if verbose:
             print("Function: {}".format(example.name))
@@ -247,13 +2717,37 @@ def extract(verbose):
             print("    Example:")
             if example.setup:
                 print("        Setup:\n{}".format(indent(example.setup, " " * 14)))
-            if example.old:
-                print("        Old: {}".format(example.old))
-            print("        New: {}".format(example.new))
+            if example.python_old:
+                print("        Old:\n{}".format(indent(example.python_old, " " * 14)))
+            print("        New:\n{}".format(indent(example.python_new, " " * 14)))
+            if example.rust:
+                print("        Rust:\n{}".format(indent(example.rust, " " * 14)))
             print("        Output: {}".format(example.output))
             print()
     print("Extracted {} examples.".format(cnt))
 
 
+@main.command()
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='-',
+              help="File to write to, defaults to stdout")
+@click.option('-f', '--format', 'fmt', type=click.Choice(['jsonl', 'json']),
+              default='jsonl', help="JSON Lines or a single minified JSON document")
+@click.option('-s', '--section', 'sections', multiple=True,
+              help="Only export sections matching this glob")
+@click.option('-n', '--name', 'names', multiple=True,
+              help="Only export examples matching this glob")
+@click.option('-c', '--content', 'content_sources', multiple=True,
+              help="Content module, directory or glob, defaults to {}".format(CONTENT_MODULE_PATH))
+@click.option('--content-order', type=click.Choice(CONTENT_ORDERS), default='path',
+              help="Order in which the content modules are merged")
+@click.option('-j', '--jobs', default=1, type=int,
+              help="Number of parallel parsing processes")
+def export(output, fmt, sections, names, content_sources, content_order, jobs):
+    content = get_content(content_sources or None, jobs=jobs, order=content_order,
+                          cache=ParseCache())
+    content = filter_content(content, sections, names)
+    output.writelines(export_content(content, fmt))
+
+
 if __name__ == "__main__":
     main()
@@ -10,7 +10,7 @@ setup(
         "Markdown==2.6.6",
         "pytest==2.9.2",
         "Pygments==2.1.3",
-        "astunparse==1.4.0",
+        "astunparse==1.4.0; python_version < '3.9'",
         "pytz==2016.6.1",
     ],
     entry_points={
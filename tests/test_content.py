@@ -1,24 +1,29 @@
 # -*- encoding: utf-8 -*-
 import sys
-from subprocess import run, PIPE
-from tempfile import NamedTemporaryFile, gettempdir
-from os import remove
 
 import pytest
 
+from main import get_content, collect_rust_snippets, run_rust_batch, RustCache
+from main import run_rust as run_rust_snippet
+
+
+_rust_outputs = {}
+
 
 def run_rust(code):
-    with NamedTemporaryFile(suffix='.rs') as file:
-        file.write(b'fn main () {\n')
-        file.write('    let s = {};\n'.format(code).encode())
-        file.write(b'    println!("{}", s);\n')
-        file.write(b'}')
-        file.flush()
-        run(["rustc", "--out-dir={}".format(gettempdir()), file.name])
-        executable = file.name.rsplit('.')[0]
-        result = run([executable], stdout=PIPE).stdout
-        remove(executable)
-    return result.decode().rstrip('\n')
+    """
+    run_rust looks up the output of the given Rust expression. All snippets of
+    this module are compiled as one program on first use unless they are
+    already in the on-disk cache; anything not found there is compiled on its
+    own.
+    """
+    if not _rust_outputs:
+        snippets = collect_rust_snippets(get_content(__file__))
+        for name, output in run_rust_batch(snippets, cache=RustCache()).items():
+            _rust_outputs[snippets[name]] = output
+    if code not in _rust_outputs:
+        _rust_outputs[code] = run_rust_snippet(code, cache=RustCache())
+    return _rust_outputs[code]
 
 
 def test_simple():
@@ -1,24 +1,71 @@
 import ast
+import gzip
+import hashlib
 import inspect
+import json
+import os
+import re
+
+from collections import OrderedDict
 
 from pathlib import Path
-from shutil import rmtree
+from shutil import copytree, rmtree
 
+import jinja2
 import wrapt
 import pytest
+import subprocess
 import sys
 
 from main import parse_docstring
 from main import parse_function
-from main import get_content
+from main import SourceSlicer
+from main import get_content, content_files, ParseCache
 from main import split_letters
 from main import generate_css
+from main import minify_html, css_rules, filter_css, html_names, inline_critical_css
+from main import purge_stylesheets, generate_pygments_scss, fetch_vendor_asset
+from main import Example, Section
+from main import collect_rust_snippets
+from main import parse_rust_batch_output
+from main import run_rust_batch
+from main import RustCache, RustResult
+from main import BuildState
+from main import git_revision, tool_version, tool_version_key, python_version
+from main import Profiler
+from main import FragmentCache
+from main import highlight, highlight_rust, highlight_many, render_markdown
+from main import LiveSite
+from main import create_environment, generate_page
+from main import paginate, page_urls, write_pages, remove_stale_pages
+from main import compress_files, generate_html, SitePaths
+from main import build_manifest, plan_deploy, deploy_build, LocalTarget
+from main import record_build, manifest_history, collect_garbage
+from main import build_search_index, write_search_index, search_terms
+from main import precompile_templates
+from main import filter_content, export_content
+from main import generate_synthetic_content, run_benchmarks, compare_benchmarks
 
 
 def test_split_letters():
     assert split_letters('a bc') == '<i>a</i><i> </i><i>b</i><i>c</i>'
 
 
+def test_highlight_many():
+    values = ['x = 1', 'y = 2', 'x = 1']
+    assert highlight_many(values) == [highlight(value) for value in values]
+    assert highlight_many(['let x = 1;'], 'rust') == [highlight_rust('let x = 1;')]
+
+
+def test_highlight_is_memoized():
+    assert highlight('z = 3') is highlight('z = 3')
+
+
+def test_render_markdown_resets_between_calls():
+    assert render_markdown('[a][1]\n\n[1]: http://a') == '<p><a href="http://a">a</a></p>'
+    assert render_markdown('[a][1]') == '<p>[a][1]</p>'
+
+
 def test_generate_css_creates_output_folder():
     here = Path(__file__).parent
     fixture_input = here / 'fixtures' / 'css' / 'sass'
@@ -53,6 +100,725 @@ def test_generate_css(tmpdir):
     assert mapping == {'style.scss': 'style.cf83e135.css'}
 
 
+def make_example(name, rust='', output='', title=None):
+    return Example(name, title, None, '', '', '', rust, output)
+
+
+def make_site(tmpdir):
+    here = Path(__file__).parent
+    copytree(str(here / 'fixtures' / 'css' / 'sass'), str(tmpdir.join('sass')))
+    return SitePaths(templates=here.parent / 'templates', sass=Path(str(tmpdir.join('sass'))),
+                     css=Path(str(tmpdir.join('css'))), search=Path(str(tmpdir.join('search'))),
+                     vendor=None, cache=Path(str(tmpdir.join('cache'))))
+
+
+def test_collect_rust_snippets():
+    content = [
+        make_example('a', rust='format!("{}", 1)'),
+        make_example('b'),
+        Section('S', None, None, [make_example('S__c', rust='format!("{}", 2)')]),
+    ]
+    snippets = collect_rust_snippets(content)
+    assert list(snippets.items()) == [('a', 'format!("{}", 1)'),
+                                      ('S__c', 'format!("{}", 2)')]
+
+
+def test_parse_rust_batch_output():
+    output = '3\nabc6\nx\ny\nz\n0\n'.encode()
+    result = parse_rust_batch_output(['a', 'b', 'c'], output)
+    assert list(result.items()) == [('a', 'abc'), ('b', 'x\ny\nz'), ('c', '')]
+
+
+def test_run_rust_batch():
+    result = run_rust_batch({
+        'a': 'format!("{:>4}", 1)',
+        'b': 'format!("{:?}", vec![1, 2])',
+    })
+    assert list(result.items()) == [('a', '   1'), ('b', '[1, 2]')]
+
+
+def test_run_rust_batch_parallel_keeps_order():
+    snippets = OrderedDict(
+        ('s{}'.format(idx), 'format!("{{}}", {})'.format(idx)) for idx in range(5))
+    result = run_rust_batch(snippets, jobs=3)
+    assert list(result.items()) == [('s{}'.format(idx), str(idx)) for idx in range(5)]
+
+
+def test_run_rust_batch_falls_back_on_compile_errors():
+    result = run_rust_batch({
+        'a': 'format!("{}", 1)',
+        'broken': 'format!("{}")',
+    })
+    assert result == {'a': '1', 'broken': ''}
+
+
+def test_rust_cache_roundtrip(tmpdir):
+    cache = RustCache(str(tmpdir))
+    assert cache.get('format!("{}", 1)') is None
+    cache.set('format!("{}", 1)', RustResult('1', 0))
+    assert cache.get('format!("{}", 1)') == RustResult('1', 0)
+    assert cache.stats()['entries'] == 1
+    assert cache.clear() == 1
+    assert cache.get('format!("{}", 1)') is None
+
+
+def test_rust_cache_skips_compilation(tmpdir, monkeypatch):
+    cache = RustCache(str(tmpdir))
+    cache.set('format!("{}", 1)', RustResult('cached', 0))
+    monkeypatch.setattr('main.evaluate_rust_batch', None)
+    assert run_rust_batch({'a': 'format!("{}", 1)'}, cache=cache) == {'a': 'cached'}
+
+
+def test_rust_cache_evicts_old_and_oversized_entries(tmpdir):
+    cache = RustCache(str(tmpdir), max_age=200)
+    for idx in range(3):
+        cache.set(str(idx), RustResult('x', 0))
+    entries = sorted(cache.entries())
+    for idx, entry in enumerate(entries):
+        os.utime(str(entry), (idx * 100, idx * 100))
+    assert cache.evict(now=250) == 1
+    cache.max_size = entries[2].stat().st_size
+    assert cache.evict(now=250) == 1
+    assert cache.entries() == [entries[2]]
+
+
+def test_build_state_skips_unchanged_stages(tmpdir):
+    source = Path(str(tmpdir.join('source.txt')))
+    source.write_text('a')
+    state_path = str(tmpdir.join('build.json'))
+    calls = []
+
+    def build():
+        state = BuildState(state_path, incremental=True)
+        result = state.run('stage', [source], lambda: calls.append(1) or len(calls))
+        state.save()
+        return result, state.skipped
+
+    assert build() == (1, [])
+    assert build() == (1, ['stage'])
+    source.write_text('b')
+    assert build() == (2, [])
+
+
+def test_build_state_reruns_stage_with_missing_outputs(tmpdir):
+    output = Path(str(tmpdir.join('output.txt')))
+    state = BuildState(incremental=True)
+    state.run('stage', ['x'], lambda: output.write_text('x'), outputs=lambda _: [output])
+    output.unlink()
+    state.run('stage', ['x'], lambda: output.write_text('x'), outputs=lambda _: [output])
+    assert state.skipped == []
+    assert output.exists()
+
+
+def test_build_state_drops_unused_stages(tmpdir, monkeypatch):
+    path = str(tmpdir.join('build.json'))
+    state = BuildState(path)
+    state.run('compress:old.css', ['a'], lambda: 1, outputs=lambda _: ['old.css.gz'])
+    state.run('compress:new.css', ['b'], lambda: 2, outputs=lambda _: ['new.css.gz'])
+    state.save()
+    assert BuildState(path).outputs() == {'old.css.gz', 'new.css.gz'}
+    monkeypatch.chdir(str(tmpdir))
+    tmpdir.join('new.css.gz').write('')
+    state = BuildState(path, incremental=True)
+    state.run('compress:new.css', ['b'], lambda: 3, outputs=lambda _: ['new.css.gz'])
+    assert state.outputs() == {'new.css.gz'}
+    state.save()
+    assert state.skipped == ['compress:new.css']
+    assert list(BuildState(path).stages) == ['compress:new.css']
+    assert BuildState(path).outputs() == {'new.css.gz'}
+
+
+def test_git_revision(tmpdir):
+    assert git_revision() == subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+
+    git = tmpdir.mkdir('.git')
+    git.join('HEAD').write('ref: refs/heads/main\n')
+    git.join('packed-refs').write('# pack-refs with: peeled fully-peeled sorted\n'
+                                  '1111 refs/heads/main\n2222 refs/tags/v1\n^3333\n')
+    nested = tmpdir.mkdir('nested')
+    assert git_revision(str(nested)) == '1111'
+    git.mkdir('refs').mkdir('heads').join('main').write('4444\n')
+    assert git_revision(str(nested)) == '4444'
+    git.join('HEAD').write('5555\n')
+    assert git_revision(str(nested)) == '5555'
+
+    worktree = tmpdir.mkdir('worktree')
+    worktree_git = git.mkdir('worktrees').mkdir('wt')
+    worktree_git.join('HEAD').write('ref: refs/heads/main\n')
+    worktree_git.join('commondir').write('../..\n')
+    worktree.join('.git').write('gitdir: ../.git/worktrees/wt\n')
+    assert git_revision(str(worktree)) == '4444'
+
+
+def test_tool_version_is_cached(tmpdir, monkeypatch):
+    tool = tmpdir.mkdir('bin').join('tool')
+    tool.write('#!/bin/sh\necho run >> {}\necho tool 1.0\n'.format(tmpdir.join('calls')))
+    tool.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmpdir.join('bin')), prepend=os.pathsep)
+    cache_path = str(tmpdir.join('versions.json'))
+    assert tool_version('tool', cache_path) == 'tool 1.0'
+    assert tool_version('tool', cache_path) == 'tool 1.0'
+    assert len(tmpdir.join('calls').readlines()) == 1
+    os.utime(str(tool), (0, 0))
+    assert tool_version('tool', cache_path) == 'tool 1.0'
+    assert len(tmpdir.join('calls').readlines()) == 2
+
+
+def test_tool_version_key_follows_rustup_overrides(tmpdir, monkeypatch):
+    cargo_bin = tmpdir.mkdir('cargo').mkdir('bin')
+    rustup = cargo_bin.join('rustup')
+    rustup.write('#!/bin/sh\n')
+    os.link(str(rustup), str(cargo_bin.join('cargo')))
+    monkeypatch.setenv('CARGO_HOME', str(tmpdir.join('cargo')))
+    monkeypatch.setenv('RUSTUP_HOME', str(tmpdir.join('rustup')))
+    project = tmpdir.mkdir('project')
+    project.mkdir('src').chdir()
+    cargo = str(cargo_bin.join('cargo'))
+    before = tool_version_key(cargo)
+    project.join('rust-toolchain.toml').write('[toolchain]\nchannel = "nightly"\n')
+    assert tool_version_key(cargo) != before
+    other = tmpdir.mkdir('other').join('cargo')
+    other.write('#!/bin/sh\n')
+    key = tool_version_key(str(other))
+    project.join('rust-toolchain.toml').write('[toolchain]\nchannel = "stable"\n')
+    os.utime(str(project.join('rust-toolchain.toml')), (0, 0))
+    assert tool_version_key(str(other)) == key
+
+
+def test_python_version():
+    assert python_version() == 'Python {}.{}.{}'.format(*sys.version_info[:3])
+
+
+def test_profiler_records_nothing_when_disabled():
+    profiler = Profiler()
+    with profiler.span('parse'):
+        pass
+    assert profiler.spans == []
+
+
+def test_profiler_trace_and_summary(tmpdir):
+    profiler = Profiler()
+    profiler.enable(Path(str(tmpdir.join('cprofile'))))
+    with profiler.stage('sass:style.scss'):
+        with profiler.span('sass', file='style.scss'):
+            pass
+        with profiler.span('sass', file='print.scss'):
+            pass
+    assert tmpdir.join('cprofile', 'sass_style.scss.prof').check()
+
+    profiler.write_trace(str(tmpdir.join('trace.json')))
+    with open(str(tmpdir.join('trace.json'))) as fp:
+        events = json.load(fp)['traceEvents']
+    assert [event['name'] for event in events] == ['sass', 'sass', 'stage:sass:style.scss']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert events[0]['args'] == {'file': 'style.scss'}
+
+    summary = profiler.summary()
+    assert [row[0] for row in summary] == ['stage:sass:style.scss', 'sass']
+    assert summary[1][1] == 2
+    assert len(profiler.summary(top=1)) == 1
+
+
+def test_fragment_cache(tmpdir):
+    templates = tmpdir.mkdir('templates')
+    templates.join('_macros.html').write(
+        '{% macro render_example(example) %}<p>{{ example.name }}</p>{% endmacro %}')
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(templates)))
+    path = str(tmpdir.join('fragments'))
+
+    fragments = FragmentCache(env, path)
+    assert fragments.render(make_example('a')) == '<p>a</p>'
+    assert fragments.render(make_example('b')) == '<p>b</p>'
+    assert (fragments.hits, fragments.misses) == (0, 2)
+
+    fragments = FragmentCache(env, path)
+    assert fragments.render(make_example('a')) == '<p>a</p>'
+    assert (fragments.hits, fragments.misses) == (1, 0)
+    fragments.prune()
+    assert len(tmpdir.join('fragments').listdir()) == 1
+
+
+def test_generate_css_compiles_once_and_writes_manifest(tmpdir, monkeypatch):
+    import sass
+    calls = []
+    compile_ = sass.compile
+    monkeypatch.setattr(sass, 'compile', lambda **kw: calls.append(kw) or compile_(**kw))
+    here = Path(__file__).parent
+    fixture_output = Path(str(tmpdir))
+    generate_css(here / 'fixtures' / 'css' / 'sass', fixture_output)
+    assert len(calls) == 1
+    assert (fixture_output / 'style.cf83e135.css.map').exists()
+    with (fixture_output / 'style.cf83e135.css').open() as fp:
+        assert fp.read().endswith('/style.cf83e135.css.map */')
+    with (fixture_output / 'manifest.json').open() as fp:
+        assert json.load(fp) == {'style.scss': 'style.cf83e135.css'}
+
+    state = BuildState()
+    generate_css(here / 'fixtures' / 'css' / 'sass', fixture_output, state=state)
+    generate_css(here / 'fixtures' / 'css' / 'sass', fixture_output, state=state)
+    assert len(calls) == 2
+    assert 'sass:style.scss' in state.skipped
+
+
+def test_generate_css_without_source_maps(tmpdir):
+    here = Path(__file__).parent
+    fixture_output = Path(str(tmpdir))
+    mapping = generate_css(here / 'fixtures' / 'css' / 'sass', fixture_output,
+                           source_maps=False)
+    assert mapping == {'style.scss': 'style.cf83e135.css'}
+    assert not (fixture_output / 'style.cf83e135.css.map').exists()
+
+
+def test_generate_css_vendors_stylesheets(tmpdir):
+    here = Path(__file__).parent
+    vendor = tmpdir.mkdir('vendor')
+    vendor.join('ribbon.min.css').write('.ribbon{color:red}')
+    fixture_output = Path(str(tmpdir.join('css')))
+    mapping = generate_css(here / 'fixtures' / 'css' / 'sass', fixture_output,
+                           vendor_folder=Path(str(vendor)))
+    name = mapping['ribbon.min.css']
+    assert name.startswith('ribbon.min.') and name != 'ribbon.min.css'
+    assert (fixture_output / name).read_text() == '.ribbon{color:red}'
+
+
+def test_minify_html():
+    html = """<!DOCTYPE html>
+<html>
+    <!-- comment -->
+    <!--[if lt IE 9]><link href="ie.css"><![endif]-->
+    <body>
+        <p>Some   <b>bold</b>
+           text</p>
+        <div class="highlight"><pre><span></span><span class="n">a</span><span class="w">  </span>
+    b</pre></div>
+        <script>if (a  <  b) {}</script>
+    </body>
+</html>
+"""
+    assert minify_html(html) == (
+        '<!DOCTYPE html> <html> <!--[if lt IE 9]><link href="ie.css"><![endif]--> <body> '
+        '<p>Some <b>bold</b> text</p> <div class="highlight"><pre><span class="n">a</span>  \n'
+        '    b</pre></div> <script>if (a  <  b) {}</script> </body> </html>')
+
+
+def test_filter_css():
+    css = ('@import url("fonts.css");/* note */html{margin:0}.a,.b{color:red}'
+           '#toc li:hover{color:blue}a[href]::after{content:"}"}'
+           '@media (max-width:10px){.b{color:red}.a>span{color:green}}'
+           '@font-face{font-family:x}')
+    assert css_rules(css)[0] == ('@import url("fonts.css")', None)
+    assert len(css_rules(css)) == 7
+    names = html_names('<html><body id="toc"><p class="a x"><span>1</span><li>2</li></p>'
+                       '<a href="#">3</a>')
+    assert filter_css(css, names) == (
+        '@import url("fonts.css");html{margin:0}.a{color:red}#toc li:hover{color:blue}'
+        'a[href]::after{content:"}"}@media (max-width:10px){.a>span{color:green}}'
+        '@font-face{font-family:x}')
+
+
+def test_inline_critical_css():
+    html = ('<html><head><link href="assets/css/a.1.css" rel="stylesheet">'
+            '<link href="assets/css/b.2.css" rel="stylesheet"></head>'
+            '<body><p class="x">Hi</p></body></html>')
+    stylesheets = {'assets/css/a.1.css': '.x{color:red}.y{color:blue}',
+                   'assets/css/b.2.css': '@import url("f.css");p{margin:0;'
+                                       'background:url(../img/p.png),url("data:x"),url(/a.png)}'}
+    result = inline_critical_css(html, stylesheets)
+    assert result.startswith('<html><head><style>.x{color:red}p{margin:0;background:'
+                             'url(assets/img/p.png),url("data:x"),url(/a.png)}</style>'
+                             '<link rel="preload" href="assets/css/a.1.css" as="style"')
+    assert '<noscript><link href="assets/css/b.2.css" rel="stylesheet"></noscript>' in result
+    assert '.y{' not in result
+    assert inline_critical_css(html, {}) == html
+
+
+def test_fetch_vendor_asset_checks_sha256(tmpdir):
+    asset = tmpdir.join('ribbon.css')
+    asset.write('.ribbon{color:red}')
+    url = Path(str(asset)).as_uri()
+    sha256 = hashlib.sha256(b'.ribbon{color:red}').hexdigest()
+    assert fetch_vendor_asset(url, sha256) == b'.ribbon{color:red}'
+    with pytest.raises(ValueError, match='expected 0000'):
+        fetch_vendor_asset(url, '0000')
+    with pytest.raises(ValueError, match='is not pinned, its sha256 is ' + sha256):
+        fetch_vendor_asset(url, None)
+
+
+def test_purge_stylesheets(tmpdir):
+    css = tmpdir.mkdir('css')
+    css.join('style.11111111.css').write('p{margin:0}.highlight .n{color:red}'
+                                         '.highlight .k{color:blue}#toc{padding:0}')
+    page = tmpdir.join('index.html')
+    page.write('<link href="css/style.11111111.css" rel="stylesheet">'
+               '<div class="highlight"><pre><span class="n">a</span></pre></div>')
+    other = tmpdir.join('other.html')
+    other.write('<link href="css/style.11111111.css" rel="stylesheet"><p id="toc">')
+    mapping = purge_stylesheets([str(page), str(other)], {'style.scss': 'style.11111111.css'},
+                                Path(str(css)))
+    name = mapping['style.scss']
+    assert name.startswith('style.') and name != 'style.11111111.css'
+    assert css.join(name).read() == 'p{margin:0}.highlight .n{color:red}#toc{padding:0}'
+    assert 'href="css/{}"'.format(name) in page.read()
+    assert 'href="css/{}"'.format(name) in other.read()
+
+
+def test_generate_pygments_scss_keeps_unchanged_file(tmpdir):
+    target = tmpdir.join('_pygments.scss')
+    generate_pygments_scss(Path(str(target)))
+    assert '.highlight' in target.read()
+    os.utime(str(target), (0, 0))
+    generate_pygments_scss(Path(str(target)))
+    assert target.mtime() == 0
+
+
+def test_live_site_rebuilds_affected_stages(tmpdir, monkeypatch):
+    monkeypatch.setattr('main.JINJA_CACHE_PATH', Path(str(tmpdir.join('cache', 'jinja'))))
+    monkeypatch.setattr('main.FRAGMENT_CACHE_PATH', Path(str(tmpdir.join('cache', 'fragments'))))
+    here = Path(__file__).parent
+    content = Path(str(tmpdir.join('test_content.py')))
+    content.write_text('def test_one():\n    """\n    # One\n    """\n')
+    sass_path = Path(str(tmpdir.join('sass')))
+    copytree(str(here / 'fixtures' / 'css' / 'sass'), str(sass_path))
+    other_fragment = tmpdir.mkdir('cache').mkdir('fragments').join('other.html')
+    other_fragment.write('<section>')
+    vendor = tmpdir.mkdir('vendor')
+    vendor.join('gh-fork-ribbon.min.css').write('.github-fork-ribbon{color:red}')
+    site = LiveSite(content, here.parent / 'templates', sass_path, Path(str(vendor)))
+    assert site.rebuild()
+    assert '/assets/css/style.cf83e135.css' in site.files
+    ribbon = '/assets/css/' + site.styles['gh-fork-ribbon.min.css']
+    assert site.files[ribbon] == ('text/css', b'.github-fork-ribbon{color:red}')
+    assert 'href="{}"'.format(ribbon[1:]).encode('utf-8') in site.files['/'][1]
+    assert b'cdnjs' not in site.files['/'][1]
+    assert other_fragment.check()
+    assert b'/__generation' in site.files['/'][1]
+
+    monkeypatch.setattr(site, 'build_css', None)
+    content.write_text('def test_two():\n    """\n    # Two\n    """\n')
+    assert site.rebuild({content})
+    assert site.generation == 2
+    assert b'<h2>Two</h2>' in site.files['/index.html'][1]
+
+
+def test_generate_page_streams_chunks(tmpdir, monkeypatch):
+    monkeypatch.setattr('main.FRAGMENT_CACHE_PATH', Path(str(tmpdir)))
+    here = Path(__file__).parent
+    env = create_environment(here.parent / 'templates')
+    content = [make_example('a'), make_example('b')]
+    chunks = generate_page(env, iter(content), {'style.scss': 'style.css'})
+    first = next(chunks)
+    assert first.startswith('<!DOCTYPE html>')
+    html = first + ''.join(chunks)
+    assert '<section id="a"' in html and '<section id="b"' in html
+
+
+def test_paginate_groups_continuations():
+    section = Section('S', 'Section', None, [make_example('S__a', title='A')])
+    content = [make_example('a', title='A'), make_example('a_2'), section,
+               make_example('b', title='B')]
+    pages = paginate(content)
+    assert list(pages) == ['a', 'S', 'b']
+    assert [e.name for e in pages['a']] == ['a', 'a_2']
+    assert page_urls(pages) == {
+        'a': 'a.html', 'a_2': 'a.html', 'S': 'S.html', 'S__a': 'S.html', 'b': 'b.html'}
+
+
+def test_paginate_reserves_names():
+    content = [make_example('index', title='Index'), make_example('index_2', title='Two')]
+    pages = paginate(content, reserved={'index'})
+    assert list(pages) == ['index-2', 'index_2']
+    assert page_urls(pages)['index'] == 'index-2.html'
+
+
+def test_remove_stale_pages(tmpdir):
+    for name in ['index.html', 'old.html', 'old.html.gz', 'new.html', 'search.json']:
+        tmpdir.join(name).write('')
+    previous = [str(tmpdir.join(name)) for name in ['index.html', 'old.html', 'search.json']]
+    remove_stale_pages(previous, [str(tmpdir.join('index.html')), str(tmpdir.join('new.html'))])
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        'index.html', 'new.html', 'search.json']
+
+
+def test_write_pages(tmpdir, monkeypatch):
+    monkeypatch.setattr('main.FRAGMENT_CACHE_PATH', Path(str(tmpdir.join('fragments'))))
+    here = Path(__file__).parent
+    env = create_environment(here.parent / 'templates')
+    content = [make_example('a', title='A'), make_example('a_2'),
+               make_example('b', title='B')]
+    output = Path(str(tmpdir.join('index.html')))
+    paths = write_pages(env, content, {'style.scss': 'style.css'}, output)
+    assert [path.name for path in paths] == ['index.html', 'a.html', 'b.html']
+    with output.open() as fp:
+        index = fp.read()
+    assert 'href="b.html#b"' in index
+    assert '<section id="details">' not in index
+    with (output.parent / 'a.html').open() as fp:
+        page = fp.read()
+    assert '<section id="a_2"' in page and '<section id="b"' not in page
+
+
+def test_compress_files_skips_unchanged_files(tmpdir):
+    path = Path(str(tmpdir.join('index.html')))
+    path.write_text('<html></html>' * 100)
+    state = BuildState()
+    compress_files([path], state=state)
+    gzip_path = Path(str(path) + '.gz')
+    assert gzip.decompress(gzip_path.read_bytes()) == path.read_bytes()
+    compress_files([path], state=state)
+    assert state.skipped == ['compress:{}'.format(path)]
+    path.write_text('<html>changed</html>')
+    compress_files([path], state=state)
+    assert gzip.decompress(gzip_path.read_bytes()) == b'<html>changed</html>'
+
+
+def test_generate_html_removes_stale_compressed_files(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    site = make_site(tmpdir)
+    state_path = str(tmpdir.join('build.json'))
+    state = BuildState(state_path)
+    paths = generate_html([make_example('a')], Path('index.html'), state=state,
+                          compress=True, site=site)
+    state.save()
+    assert 'index.html.gz' in paths and Path('index.html.gz').exists()
+    state = BuildState(state_path)
+    paths = generate_html([make_example('b')], Path('index.html'), state=state, site=site)
+    assert not any(path.endswith('.gz') for path in paths)
+    assert not list(tmpdir.visit('*.gz'))
+
+
+def test_generate_html_rerenders_when_purge_changes(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    site = make_site(tmpdir)
+    state_path = str(tmpdir.join('build.json'))
+    for purge in [True, False]:
+        state = BuildState(state_path, incremental=True)
+        paths = generate_html([make_example('a')], Path('index.html'), state=state,
+                              content_inputs=['content'], purge=purge, site=site)
+        state.save()
+        assert 'render' not in state.skipped
+        linked = re.findall(r'href="assets/css/([^"]+)"', tmpdir.join('index.html').read())
+        assert linked and all(str(site.css / name) in paths for name in linked)
+
+
+def test_build_search_index():
+    content = [
+        Example('pad', 'Padding', 'Align values **right**.', '', "'%10s' % ('x',)",
+                "'{:>10}'.format('x')", 'format!("{:>10}", "x")', '         x'),
+        Example('pad_2', None, None, '', "'%-10s' % ('x',)", '', '', ''),
+        Section('Dates', 'Dates', None, [make_example('Dates__dt', title='Datetime')]),
+    ]
+    index = build_search_index(content, {'pad_2': 'pad.html'})
+    assert index['docs'] == [['Padding', '#pad'], ['Padding', 'pad.html#pad_2'],
+                             ['Datetime', '#Dates__dt']]
+    assert index['terms'] == sorted(index['terms'])
+    postings = dict(zip(index['terms'], index['postings']))
+    assert postings['{:>10}'] == [0]
+    assert postings['%10s'] == [0]
+    assert postings['%-10s'] == [1]
+    assert postings['right'] == [0]
+    assert postings['datetime'] == [2]
+
+
+def test_search_terms_skip_operators():
+    example = Example('a', None, None, '', "'%(a)s %-5d' % (x, 1)", "'{:>10}'.format(x % 2)",
+                      'format!("{:?}", \'%\')', '')
+    assert search_terms(example) == {'%(a)s', '%-5d', '{:>10}', '{:?}'}
+
+
+def test_write_search_index(tmpdir):
+    index = build_search_index([make_example('a', title='Alpha')])
+    path = write_search_index(index, Path(str(tmpdir)))
+    assert path.name.startswith('search.') and path.suffix == '.json'
+    with path.open() as fp:
+        assert json.load(fp) == json.loads(json.dumps(index))
+    assert write_search_index(index, Path(str(tmpdir))) == path
+
+
+def test_plan_deploy_sends_assets_first():
+    manifest = OrderedDict([('assets/css/style.2.css', 'b'), ('index.html', 'c'),
+                            ('index.html.gz', 'd'), ('assets/css/style.2.css.gz', 'e'),
+                            ('assets/search/search.1.json', 'a')])
+    deployed = {'assets/search/search.1.json': 'a', 'index.html': 'x'}
+    assert plan_deploy(manifest, deployed) == [
+        'assets/css/style.2.css', 'assets/css/style.2.css.gz', 'index.html', 'index.html.gz']
+
+
+def test_deploy_build_to_local_target(tmpdir):
+    build = tmpdir.mkdir('build')
+    build.join('index.html').write('<html>')
+    build.mkdir('assets').join('style.1.css').write('body {}')
+    paths = [str(build.join('index.html')), str(build.join('assets', 'style.1.css'))]
+    target = LocalTarget(str(tmpdir.join('site')))
+
+    manifest = build_manifest(paths, str(build))
+    assert list(manifest) == ['assets/style.1.css', 'index.html']
+    assert deploy_build(manifest, target, str(build), dry_run=True) == list(manifest)
+    assert not tmpdir.join('site').check()
+    assert deploy_build(manifest, target, str(build)) == list(manifest)
+    assert tmpdir.join('site', 'assets', 'style.1.css').read() == 'body {}'
+    assert deploy_build(manifest, target, str(build)) == []
+
+    build.join('index.html').write('<html><body>')
+    assert deploy_build(build_manifest(paths, str(build)), target, str(build)) == ['index.html']
+    assert tmpdir.join('site', 'index.html').read() == '<html><body>'
+
+
+def test_build_manifest_rejects_outside_paths(tmpdir):
+    tmpdir.join('index.html').write('<html>')
+    with pytest.raises(ValueError, match='outside of the site folder'):
+        build_manifest([str(tmpdir.join('index.html'))], str(tmpdir.mkdir('build')))
+
+
+def test_record_build_keeps_history(tmpdir):
+    history = str(tmpdir.join('manifests'))
+    for idx in range(4):
+        record_build({'index.html': str(idx)}, history, keep=2)
+    assert [m['index.html'] for m in manifest_history(history)] == ['3', '2', '1']
+    record_build({'index.html': '1'}, history, keep=2)
+    assert [m['index.html'] for m in manifest_history(history)] == ['1', '3', '2']
+
+
+def test_collect_garbage(tmpdir):
+    css = tmpdir.mkdir('assets').mkdir('css')
+    for name in ['style.11111111.css', 'style.11111111.css.map', 'style.22222222.css',
+                 'style.33333333.css', 'style.33333333.css.gz', 'manifest.json']:
+        css.join(name).write(name)
+    manifests = [{'assets/css/style.33333333.css': 'c', 'assets/css/style.33333333.css.gz': 'd'},
+                 {'assets/css/style.22222222.css': 'b'}]
+    folders = [Path('assets/css'), Path('assets/search')]
+    root = Path(str(tmpdir))
+    expected = [root / 'assets/css/style.11111111.css', root / 'assets/css/style.11111111.css.map']
+    assert collect_garbage(manifests, folders, root, dry_run=True) == expected
+    assert len(css.listdir()) == 6
+    assert collect_garbage(manifests, folders, root) == expected
+    assert sorted(path.basename for path in css.listdir()) == [
+        'manifest.json', 'style.22222222.css', 'style.33333333.css', 'style.33333333.css.gz']
+
+
+def test_precompiled_templates(tmpdir, monkeypatch):
+    monkeypatch.setattr('main.CACHE_PATH', Path(str(tmpdir.join('cache'))))
+    monkeypatch.setattr('main.JINJA_CACHE_PATH', Path(str(tmpdir.join('cache', 'jinja'))))
+    monkeypatch.setattr('main.FRAGMENT_CACHE_PATH', Path(str(tmpdir.join('fragments'))))
+    templates = Path(str(tmpdir.join('templates')))
+    copytree(str(Path(__file__).parent.parent / 'templates'), str(templates))
+    archive = precompile_templates(templates)
+    assert archive.exists()
+
+    env = create_environment(templates)
+    assert isinstance(env.loader.loaders[0], jinja2.ModuleLoader)
+    html = ''.join(generate_page(env, [make_example('a')], {'style.scss': 'style.css'}))
+    assert '<section id="a"' in html
+
+    (templates / 'page.html').write_text('changed')
+    assert not isinstance(create_environment(templates).loader, jinja2.ChoiceLoader)
+    archive = precompile_templates(templates)
+    assert isinstance(create_environment(templates).loader.loaders[0], jinja2.ModuleLoader)
+    archive.unlink()
+    assert not isinstance(create_environment(templates).loader, jinja2.ChoiceLoader)
+
+
+def test_generate_synthetic_content(tmpdir):
+    testfile = tmpdir.join('test_content.py')
+    testfile.write(generate_synthetic_content(25, 2))
+    content = list(get_content(filename=Path(str(testfile))))
+    sections = [item for item in content if isinstance(item, Section)]
+    assert len(sections) == 2
+    assert len(content) - 2 + sum(len(s.examples) for s in sections) == 25
+    example = content[0]
+    assert example.title == 'Synthetic example 0'
+    assert example.python_new == "'{:1}'.format(value)"
+    assert example.rust == 'format!("{:1}", 0)'
+    assert example.output == '0'
+
+
+def test_run_benchmarks():
+    results = run_benchmarks([10], repeat=1, stages=('get_content', 'parse_function'))
+    assert list(results['results']) == ['10']
+    assert set(results['results']['10']) == {'get_content', 'parse_function'}
+
+
+def test_compare_benchmarks():
+    baseline = {'results': {'10': {'get_content': 1.0, 'highlight': 1.0}}}
+    current = {'results': {'10': {'get_content': 1.2, 'highlight': 1.5},
+                           '100': {'get_content': 9.0}}}
+    assert compare_benchmarks(baseline, current) == [('10', 'highlight', 1.0, 1.5)]
+
+
+# Modules that are only imported by the commands that need them.
+LAZY_MODULES = {'jinja2', 'sass', 'markdown', 'pygments', 'pytz', 'markupsafe',
+                'http.server', 'brotli', 'concurrent.futures'}
+
+# Upper bound for the time spent importing the dependencies of main, in
+# microseconds. Generous on purpose, the module check above is the strict one.
+IMPORT_TIME_BUDGET = 200000
+
+
+def import_times(*args):
+    """
+    import_times runs python -X importtime with the given arguments and
+    returns a mapping of imported module -> (self, cumulative) microseconds.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + list(args),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=str(Path(__file__).parent.parent))
+    times = {}
+    for line in result.stderr.decode().splitlines():
+        if line.startswith('import time:') and 'cumulative' not in line:
+            self_time, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = (int(self_time), int(cumulative))
+    return times
+
+
+def test_import_main_is_fast():
+    times = import_times('-c', 'import main')
+    assert not LAZY_MODULES & set(times)
+    self_time, cumulative = times['main']
+    assert cumulative - self_time < IMPORT_TIME_BUDGET
+
+
+def test_extract_skips_rendering_stack():
+    times = import_times('main.py', 'extract', '--verbose')
+    assert 'ast' in times
+    assert not LAZY_MODULES & set(times)
+
+
+def test_export_skips_rendering_stack():
+    times = import_times('main.py', 'export')
+    assert 'ast' in times
+    assert not LAZY_MODULES & set(times)
+
+
+def test_filter_content():
+    content = [
+        make_example('simple'),
+        Section('Padding', None, None, [make_example('Padding__pad'),
+                                        make_example('Padding__align')]),
+        Section('Other', None, None, [make_example('Other__pad')]),
+    ]
+    assert list(filter_content(content)) == content
+    assert [item.name for item in filter_content(content, names=['*pad'])] == ['Padding', 'Other']
+    result = list(filter_content(content, sections=['Pad*'], names=['*align']))
+    assert len(result) == 1
+    assert [example.name for example in result[0].examples] == ['Padding__align']
+
+
+def test_export_content():
+    content = [
+        make_example('simple', rust='format!("{}", 1)', output='1'),
+        Section('Padding', 'Padding', None, [make_example('Padding__pad')]),
+    ]
+    lines = list(export_content(content))
+    assert len(lines) == 2
+    records = [json.loads(line) for line in lines]
+    assert records[0]['type'] == 'example'
+    assert records[0]['rust'] == 'format!("{}", 1)'
+    assert records[1]['type'] == 'section'
+    assert records[1]['examples'][0]['name'] == 'Padding__pad'
+    document = ''.join(export_content(content, 'json'))
+    assert json.loads(document) == records
+    assert '": ' not in document and '\n' not in document.rstrip()
+
+
 def test_parse_docstring_without_docstring():
     assert parse_docstring('') == (None, None)
     assert parse_docstring('  ') == (None, None)
@@ -93,7 +859,7 @@ def dummy_long():
     assert old_result == new_result
 
 
-@pytest.mark.xfail(sys.version_info >= (3, 5), reason="astunparse is currently broken on Python >= 3.5")
+@pytest.mark.xfail((3, 5) <= sys.version_info < (3, 9), reason="astunparse is currently broken on Python >= 3.5")
 def test_parse_function_complete():
     example = parse_function(func_to_ast(dummy_long))
 
@@ -101,8 +867,8 @@ def test_parse_function_complete():
     assert example.title == "Title"
     assert example.details == "Blah"
     assert example.setup == "x = {'a': 1}"
-    assert example.old == "'%(a)s' % x"
-    assert example.new == "'{x.a}'.format(x=x)"
+    assert example.python_old == "'%(a)s' % x"
+    assert example.python_new == "'{x.a}'.format(x=x)"
     assert example.output == "1"
 
 
@@ -112,7 +878,7 @@ def dummy_minimal():
     assert new_result == "1"  # output
 
 
-@pytest.mark.xfail(sys.version_info >= (3, 5), reason="astunparse is currently broken on Python >= 3.5")
+@pytest.mark.xfail((3, 5) <= sys.version_info < (3, 9), reason="astunparse is currently broken on Python >= 3.5")
 def test_parse_function_minimal():
     example = parse_function(func_to_ast(dummy_minimal))
 
@@ -120,11 +886,40 @@ def test_parse_function_minimal():
     assert example.title is None
     assert example.details is None
     assert example.setup == ""
-    assert example.old == ""
-    assert example.new == "'{}'.format(1)"
+    assert example.python_old == ""
+    assert example.python_new == "'{}'.format(1)"
     assert example.output == "1"
 
 
+def dummy_formatted():
+    """
+    # Título
+    """
+    @dummy_decorator
+    def f(x):  # keeps comments
+        return x
+
+    old_result = '%s, %s' % ('ä',  f(1), )
+    new_result = '{}, {}'.format(
+        'ä', f(1))
+    rust_result = 'format!("{}, {}", "ä", 1)'
+
+    assert new_result == 'ä, 1'  # output
+
+
+@pytest.mark.skipif(not SourceSlicer.supported(), reason="needs end positions of nodes")
+def test_parse_function_keeps_source_formatting():
+    source = inspect.getsource(dummy_formatted)
+    example = parse_function(ast.parse(source).body[0], SourceSlicer(source))
+
+    assert example.title == "Título"
+    assert example.setup == "@dummy_decorator\ndef f(x):  # keeps comments\n    return x"
+    assert example.python_old == "'%s, %s' % ('ä',  f(1), )"
+    assert example.python_new == "'{}, {}'.format(\n        'ä', f(1))"
+    assert example.rust == 'format!("{}, {}", "ä", 1)'
+    assert example.output == "ä, 1"
+
+
 def dummy_empty():
     pass
 
@@ -180,7 +975,59 @@ class TestSomethingElse():
     assert section.examples[0].name == "SomethingElse__se"
 
 
-@pytest.mark.xfail(sys.version_info >= (3, 5), reason="astunparse is currently broken on Python >= 3.5")
+def write_content_modules(tmpdir, names):
+    for name in names:
+        tmpdir.join(name).write('def test_{0}():\n    """\n    # {0}\n    """\n'.format(
+            name[len('test_'):-len('.py')]))
+
+
+def test_content_files(tmpdir):
+    write_content_modules(tmpdir, ['test_b.py', 'test_a.py'])
+    tmpdir.join('helpers.py').write('')
+    root = Path(str(tmpdir))
+    assert content_files(root) == [root / 'test_a.py', root / 'test_b.py']
+    assert content_files(str(root / '*.py')) == [
+        root / 'helpers.py', root / 'test_a.py', root / 'test_b.py']
+    sources = [root / 'test_b.py', str(root / 'test_*.py')]
+    assert content_files(sources) == [root / 'test_a.py', root / 'test_b.py']
+    assert content_files(sources, 'given') == [root / 'test_b.py', root / 'test_a.py']
+    with pytest.raises(ValueError):
+        content_files(root, 'random')
+
+
+def test_get_content_in_parallel(tmpdir):
+    write_content_modules(tmpdir, ['test_{}.py'.format(name) for name in 'dcba'])
+    serial = list(get_content(Path(str(tmpdir))))
+    assert [example.name for example in serial] == ['a', 'b', 'c', 'd']
+    assert list(get_content(Path(str(tmpdir)), jobs=3)) == serial
+
+
+def test_get_content_uses_parse_cache(tmpdir, monkeypatch):
+    import main
+    content = tmpdir.mkdir('content')
+    write_content_modules(content, ['test_a.py', 'test_b.py'])
+    content.join('test_b.py').write('class TestB():\n    def test_b(self):\n        pass\n', mode='a')
+    cache = ParseCache(str(tmpdir.join('cache')))
+    parsed = list(get_content(Path(str(content)), cache=cache))
+    assert isinstance(parsed[2], Section)
+
+    parse_module = main.parse_module
+    calls = []
+    monkeypatch.setattr(main, 'parse_module', lambda path: calls.append(path.name) or parse_module(path))
+    assert list(get_content(Path(str(content)), cache=cache)) == parsed
+    assert calls == []
+
+    write_content_modules(content, ['test_a.py'])
+    content.join('test_a.py').write('def test_c():\n    pass\n', mode='a')
+    assert len(list(get_content(Path(str(content)), cache=cache))) == 4
+    assert calls == ['test_a.py']
+
+    monkeypatch.setattr(main, 'PARSER_VERSION', main.PARSER_VERSION + 1)
+    list(get_content(Path(str(content)), cache=cache))
+    assert calls == ['test_a.py', 'test_a.py', 'test_b.py']
+
+
+@pytest.mark.xfail((3, 5) <= sys.version_info < (3, 9), reason="astunparse is currently broken on Python >= 3.5")
 def test_get_content(tmpdir):
     testfile = tmpdir.join('test_content.py')
     testfile.write('''